@@ -21,6 +21,7 @@ SRVis  Copyright (C) 2015  Niklas Berliner
 __version__ = 'SRVis version 0.1'
 
 import sys
+import time
 sys.path.insert(1,'lib')
  
 # Import the core and GUI elements of Qt
@@ -38,6 +39,7 @@ matplotlib.rcParams['backend.qt4']='PyQt4'
 from dataHandler    import dataHandler
 from imageClass     import overlayWidget, dataWidget, imageHistogramWidget
 from SRVisInterface import openDialog, PyMultiPageWidget
+from jobRunner      import jobRunner
 
 
 class SRVis(QMainWindow):
@@ -72,6 +74,11 @@ class SRVis(QMainWindow):
         
         self.initialised   = False
         
+        # Loading, filtering and the image histogram are computed in a
+        # background thread to keep the user interface responsive
+        self.jobs = jobRunner(self)
+        QCoreApplication.instance().aboutToQuit.connect(self.jobs.stop)
+        
         # Create the main layout
         #
         # ________________________
@@ -119,7 +126,15 @@ class SRVis(QMainWindow):
         self.QTscaleMin   = QLineEdit(self)
         self.QTscaleMax   = QLineEdit(self)
         self.QTHistBlur   = QCheckBox(self)
+        self.QTRenderMode = QComboBox(self)
         self.QTBlurSigma  = QLineEdit(self)
+        self.QTQuadTreeEps  = QLineEdit(self)
+        self.QTQuadTreeUnit = QLineEdit(self)
+        self.QTROIMode    = QComboBox(self)
+        self.QTGroupRadius = QLineEdit(self)
+        self.QTGroupGap    = QLineEdit(self)
+        self.QTFiducialRadius = QLineEdit(self)
+        self.QTDriftMode      = QComboBox(self)
         self.scalebar     = QLineEdit(self)
         
         self.frame.setSingleStep(1)
@@ -131,6 +146,11 @@ class SRVis(QMainWindow):
         self.QTscaleMin.setPlaceholderText("Auto")
         self.QTscaleMax.setPlaceholderText("Auto")
         self.QTBlurSigma.setPlaceholderText("20")
+        self.QTQuadTreeEps.setPlaceholderText("10")
+        self.QTQuadTreeUnit.setPlaceholderText("10")
+        self.QTGroupRadius.setPlaceholderText("None")
+        self.QTGroupGap.setPlaceholderText("0")
+        self.QTFiducialRadius.setPlaceholderText("200")
         self.scalebar.setPlaceholderText("None")
         
         self.frame.valueChanged.connect(self.frameValueChange)
@@ -139,7 +159,38 @@ class SRVis(QMainWindow):
         self.QTscaleMin.returnPressed.connect(self.changeQTscaleMin)
         self.QTscaleMax.returnPressed.connect(self.changeQTscaleMax)
         self.QTHistBlur.stateChanged.connect(self.changeQTBlur)
+        
+        # The available 2D histogram render modes (label, mode)
+        self.renderModes = [ ('Histogram',    'histogram'),
+                             ('Tile pyramid', 'pyramid'),
+                             ('Zoom re-binning', 'rebin'),
+                             ('Gaussian rendering', 'splat'),
+                             ('Quadtree density', 'quadtree') ]
+        for label, _ in self.renderModes:
+            self.QTRenderMode.addItem(label)
+        self.QTRenderMode.currentIndexChanged.connect(self.changeRenderMode)
         self.QTBlurSigma.returnPressed.connect(self.changedSigma)
+        self.QTQuadTreeEps.returnPressed.connect(self.changeQuadTree)
+        self.QTQuadTreeUnit.returnPressed.connect(self.changeQuadTree)
+        
+        # The ways to select a region of interest in the 2D histogram (label, mode)
+        self.roiModes = [ ('None',      None),
+                          ('Rectangle', 'rectangle'),
+                          ('Polygon',   'polygon') ]
+        for label, _ in self.roiModes:
+            self.QTROIMode.addItem(label)
+        self.QTROIMode.currentIndexChanged.connect(self.changeROIMode)
+        self.QTGroupRadius.returnPressed.connect(self.groupData)
+        self.QTGroupGap.returnPressed.connect(self.groupData)
+        self.QTFiducialRadius.returnPressed.connect(self.detectFiducials)
+        
+        # The available drift corrections (label, method)
+        self.driftModes = [ ('None',              None),
+                            ('Fiducials',         'fiducials'),
+                            ('Cross-correlation', 'rcc') ]
+        for label, _ in self.driftModes:
+            self.QTDriftMode.addItem(label)
+        self.QTDriftMode.currentIndexChanged.connect(self.changeDriftMode)
         self.scalebar.returnPressed.connect(self.setScalebar)
         
         # Add them to the form layout with a label
@@ -148,8 +199,16 @@ class SRVis(QMainWindow):
         self.form_layout.addRow('Bin size (in px):', self.HistBinSize)
         self.form_layout.addRow('2D histogram scale max.:', self.QTscaleMax)
         self.form_layout.addRow('2D histogram scale min.:', self.QTscaleMin)
+        self.form_layout.addRow('2D histogram mode:', self.QTRenderMode)
         self.form_layout.addRow('Apply gaussian blur:', self.QTHistBlur)
         self.form_layout.addRow('Gaussian blur sigma (in nm):', self.QTBlurSigma)
+        self.form_layout.addRow('Quadtree max. loc. per bin:', self.QTQuadTreeEps)
+        self.form_layout.addRow('Quadtree min. bin size (in nm):', self.QTQuadTreeUnit)
+        self.form_layout.addRow('Region of interest:', self.QTROIMode)
+        self.form_layout.addRow('Grouping radius (in nm):', self.QTGroupRadius)
+        self.form_layout.addRow('Grouping max. gap (in frames):', self.QTGroupGap)
+        self.form_layout.addRow('Fiducial radius (in nm):', self.QTFiducialRadius)
+        self.form_layout.addRow('Drift correction:', self.QTDriftMode)
         self.form_layout.addRow('Add scalebar (in nm):', self.scalebar)
         
         self.reloadImageButton  = QPushButton('&Update Image Histogram', self)
@@ -242,6 +301,34 @@ class SRVis(QMainWindow):
         self.frameSlider.valueChanged.connect(self.frameValueChange)
         self.mainFrame.addWidget(self.frameSlider)
         
+        # Add the playback controls
+        self.playbackLayout = QHBoxLayout()
+        self.playButton     = QPushButton('&Play', self)
+        self.playbackFps    = QSpinBox(self)
+        self.playbackStep   = QSpinBox(self)
+        self.playbackInfo   = QLabel('', self)
+        
+        self.playbackFps.setRange(1, 200)
+        self.playbackFps.setValue(25)
+        self.playbackFps.setSuffix(' fps')
+        self.playbackStep.setRange(1, 1000)
+        self.playbackStep.setValue(1)
+        self.playbackStep.setPrefix('step ')
+        
+        self.playButton.clicked.connect(self.togglePlayback)
+        
+        self.playbackLayout.addWidget(self.playButton)
+        self.playbackLayout.addWidget(self.playbackFps)
+        self.playbackLayout.addWidget(self.playbackStep)
+        self.playbackLayout.addWidget(self.playbackInfo)
+        self.playbackLayout.addStretch(1)
+        self.mainFrame.addLayout(self.playbackLayout)
+        
+        # The timer drives the playback. Timer events that fire while a frame
+        # is still being drawn are merged by Qt, i.e. redraws are never queued.
+        self.playTimer = QTimer(self)
+        self.playTimer.timeout.connect(self.playbackTick)
+        
         # Add a statusbar message
         self.statusBar()
         
@@ -254,6 +341,8 @@ class SRVis(QMainWindow):
         self.scaleMax      = None
         self.blurHistogram = False
         self.sigma         = 1.0
+        self.quadTreeEps   = 10
+        self.quadTreeUnit  = 10.0 # in nm
         self.dataTypes     = list()
         self.filterValues  = dict()
 
@@ -265,6 +354,9 @@ class SRVis(QMainWindow):
     
     def statusBusy(self, msg='Status: Busy..'):
         self.statusBar().showMessage('Status: ' + msg)
+    
+    def statusFailed(self, msg):
+        self.statusBar().showMessage('Status: ' + msg + ' Failed')
         
     def updateHistogramm(self):
         self.statusBusy('Updating histograms..')
@@ -280,9 +372,12 @@ class SRVis(QMainWindow):
     def frameValueChange(self, frame):
         assert( isinstance(frame, int) )
         
-        # Set both input field to the new value
-        self.frameSlider.setValue( frame )
-        self.frame.setValue(frame)
+        # Set both input field to the new value. The signals are blocked to
+        # not trigger another redraw of the same frame.
+        for widget in (self.frameSlider, self.frame):
+            widget.blockSignals(True)
+            widget.setValue(frame)
+            widget.blockSignals(False)
         
         # Update the image
         try:
@@ -294,6 +389,59 @@ class SRVis(QMainWindow):
             pass
         
         
+    def togglePlayback(self):
+        if self.playTimer.isActive():
+            self.stopPlayback()
+        else:
+            self.startPlayback()
+    
+    def startPlayback(self):
+        if self.data is None or self.data.maxImageFrame() == 0:
+            return
+        
+        self.playFps   = self.playbackFps.value()
+        self.playStep  = self.playbackStep.value()
+        self.playFirst = self.frame.value()
+        if self.playFirst >= self.data.maxImageFrame() - 1: # start over
+            self.playFirst = 0
+            self.frameValueChange(0)
+        
+        # Frames are selected by the elapsed time. If drawing falls behind,
+        # the frames in between are skipped and counted as dropped.
+        self.playStartTime = time.time()
+        self.playLastTick  = 0
+        self.playShown     = 0
+        self.playDropped   = 0
+        
+        # Let the TIFF reader decode the upcoming frames in the background
+        self.data.setPlaybackStep(self.playStep)
+        
+        self.playTimer.start(int(1000.0 / self.playFps))
+        self.playButton.setText('&Pause')
+    
+    def stopPlayback(self):
+        self.playTimer.stop()
+        self.playButton.setText('&Play')
+        if self.data is not None:
+            self.data.setPlaybackStep(None)
+    
+    def playbackTick(self):
+        elapsed = time.time() - self.playStartTime
+        tick    = int(elapsed * self.playFps) # the frame that should be shown now
+        if tick <= self.playLastTick:
+            return
+        self.playDropped  += tick - self.playLastTick - 1
+        self.playLastTick  = tick
+        
+        lastFrame = self.data.maxImageFrame() - 1
+        frame     = min(self.playFirst + tick * self.playStep, lastFrame)
+        self.frameValueChange(frame)
+        self.playShown += 1
+        
+        self.playbackInfo.setText( "%.1f fps, %d dropped" %(self.playShown / elapsed, self.playDropped) )
+        if frame == lastFrame:
+            self.stopPlayback()
+    
     def changeMarkerSize(self):
         try:
             size = int(self.markerSize.text())
@@ -305,20 +453,27 @@ class SRVis(QMainWindow):
     
     
     def changeImageHistogram(self, scaleMin, scaleMax, binSize):
+        # The histogram is computed in the background and drawn once it is done
         self.statusBusy('Updating image histogram..')
-        self.QTHistogram.plot(scaleMin, scaleMax, binSize)
+        self.jobs.submit('imageHistogram', self.QTHistogram.updateHistogram, (scaleMin, scaleMax, binSize),
+                         callback=self.drawImageHistogram,
+                         errorCallback=lambda error: self.statusFailed('Updating image histogram..'))
+    
+    def drawImageHistogram(self, result=None):
+        self.QTHistogram.drawHistogram()
         self.QTHistogram.redraw()
-        self.statusReady('Updating image histogram..')
+        if self.QTHistogram.blurInfo is None:
+            self.statusReady('Updating image histogram..')
+        else: # report which gaussian blur was used
+            self.statusReady('Updating image histogram (gaussian blur: %s, %.3f s)..' %self.QTHistogram.blurInfo)
     
     def changeBinSize(self):
         try:
             self.binSize = float(self.HistBinSize.text())
         except ValueError: # nothing entered
             return
-        self.statusBusy('Updating bin size..')
         self.updateSigma()
         self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
-        self.statusReady('Updating bin size..')
             
     def changeQTscaleMin(self):
         if str(self.QTscaleMin.text()).lower() == 'auto':
@@ -328,9 +483,7 @@ class SRVis(QMainWindow):
                 self.scaleMin = float(self.QTscaleMin.text())
             except ValueError: # nothing entered
                 return
-        self.statusBusy('Rescaling image histogram..')
         self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
-        self.statusReady('Rescaling image histogram..')
     
     def changeQTscaleMax(self):
         if str(self.QTscaleMax.text()).lower() == 'auto':
@@ -340,27 +493,66 @@ class SRVis(QMainWindow):
                 self.scaleMax = float(self.QTscaleMax.text())
             except ValueError: # nothing entered
                 return
-        self.statusBusy('Rescaling image histogram..')
         self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
-        self.statusReady('Rescaling image histogram..')
     
     def changeQTBlur(self):
         self.blurHistogram = self.QTHistBlur.isChecked()
         if self.initialised: # only try to plot once initialized
-            self.statusBusy('Blurring image histogram..')
             # Set the gaussian blur
             self.QTHistogram.setGaussianBlur(self.blurHistogram, self.sigma)
             # Update the histogram
             self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
-            self.statusReady('Blurring image histogram..')
     
     
+    def changeQuadTree(self):
+        try:
+            if str(self.QTQuadTreeEps.text()):
+                self.quadTreeEps  = int(self.QTQuadTreeEps.text())
+            if str(self.QTQuadTreeUnit.text()):
+                self.quadTreeUnit = float(self.QTQuadTreeUnit.text())
+        except ValueError: # no valid number entered
+            return
+        if self.initialised: # only try to plot once initialized
+            self.QTHistogram.setQuadTreeParameters(self.quadTreeEps, self.quadTreeUnit / self.pxSize)
+            self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
+    
+    def changeRenderMode(self, index):
+        if self.initialised: # only try to plot once initialized
+            self.QTHistogram.setRenderMode(self.renderModes[index][1])
+            self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
+    
+    def changeROIMode(self, index):
+        if self.initialised: # only try to change once initialized
+            self.QTHistogram.setROIMode(self.roiModes[index][1])
+    
+    def changeROI(self, vertices):
+        # Resolve the ROI in the background, the histograms and statistics
+        # are updated once it is done
+        if self.data is None: # no data loaded (yet)
+            return
+        self.statusBusy('Selecting region of interest..')
+        self.jobs.submit('roi', self.data.setROI, (vertices,),
+                         callback=self.filteredData,
+                         errorCallback=lambda error: self.statusFailed('Selecting region of interest..'))
+    
+    def imageHistogramPrecision(self):
+        """ The localisation precision in x and y (in pixels) used for the
+        gaussian rendering, None if it is not available """
+        localisations = self.data.data.localisations()
+        if 'Uncertainty x' not in localisations.columns:
+            return None
+        if 'Uncertainty y' in localisations.columns:
+            precision = localisations[['Uncertainty x', 'Uncertainty y']]
+        else:
+            precision = localisations[['Uncertainty x', 'Uncertainty x']]
+        return np.asarray(precision) / self.pxSize
+    
     def updateImageHistogramData(self):
-        self.statusBusy('Updateting image data..')
         d = np.asarray(self.data.data.localisations()[['x','y']])
-        self.QTHistogram.setData(d)
+        # The rebin mode reuses the spatial index of the localisations, it is
+        # built on the worker thread once the mode needs it
+        self.QTHistogram.setData(d, self.imageHistogramPrecision(), self.data.data.spatialIndex)
         self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
-        self.statusReady('Updateting image data..')
 
     @pyqtSlot(str, str)
     def setHome(self, home):
@@ -371,24 +563,82 @@ class SRVis(QMainWindow):
     def reloadData(self):
         if self.data is not None:
             self.statusBusy('Reloading localisation data..')
-            self.data.reloadData('localisations') # Update the localisation data
-            
+            # Update the localisation data in the background
+            self.jobs.submit('reloadData', self.data.reloadData, ('localisations',),
+                             callback=self.reloadedData,
+                             errorCallback=lambda error: self.statusFailed('Reloading localisation data..'))
+        return
+    
+    def reloadedData(self, result=None):
+        if self.data is not None:
             # Update the localisation count
             self.localisationCountTotal.setText( str(len(self.data.data.localisations())) )
             
-            # Update the histograms
-            self.updateHistograms()
-            self.plotFrame.redraw()
-            
             # Update the image histogram
             self.updateImageHistogramData()
             
-            self.statusReady(None)
+            # Keep the selected region of interest for the new data, the
+            # histograms and the frame are updated once it is resolved
+            self.changeROI(self.QTHistogram.roi)
         return
 
+    def groupData(self):
+        # Link the localisations of the same emitter in subsequent frames,
+        # no radius undoes the grouping
+        try:
+            radius = str(self.QTGroupRadius.text())
+            radius = None if radius in ('', 'None') else float(radius) / self.pxSize
+            gapLength = str(self.QTGroupGap.text())
+            gapLength = 0 if gapLength == '' else int(gapLength)
+        except ValueError: # no valid number entered
+            return
+        if self.data is not None:
+            self.statusBusy('Grouping localisations..')
+            self.jobs.submit('groupData', self.data.groupData, (radius, gapLength),
+                             callback=self.reloadedData,
+                             errorCallback=lambda error: self.statusFailed('Grouping localisations..'))
+    
+    def detectFiducials(self):
+        # Search for fiducial markers, i.e. spots present in most frames
+        try:
+            radius = str(self.QTFiducialRadius.text())
+            radius = 200.0 if radius == '' else float(radius)
+        except ValueError: # no valid number entered
+            return
+        if self.data is not None:
+            self.statusBusy('Detecting fiducials..')
+            self.jobs.submit('fiducials', self.data.detectFiducials, (radius / self.pxSize,),
+                             callback=self.detectedFiducials,
+                             errorCallback=lambda error: self.statusFailed('Detecting fiducials..'))
+    
+    def detectedFiducials(self, nrFiducials):
+        self.statusReady('Detecting fiducials (%d found)..' %nrFiducials)
+    
+    def changeDriftMode(self, index):
+        if self.initialised and self.data is not None: # only try to correct once initialized
+            self.statusBusy('Correcting drift..')
+            self.jobs.submit('driftCorrection', self.data.correctDrift, (self.driftModes[index][1],),
+                             callback=self.correctedDrift,
+                             errorCallback=lambda error: self.correctedDrift(False))
+    
+    def correctedDrift(self, success):
+        if self.data is None: # the data was closed in the meantime
+            return
+        if not success: # e.g. no fiducials detected
+            # Show the correction that is still applied
+            method = self.data.data.driftMethod
+            self.QTDriftMode.blockSignals(True)
+            self.QTDriftMode.setCurrentIndex([ mode for _, mode in self.driftModes ].index(method))
+            self.QTDriftMode.blockSignals(False)
+            self.statusFailed('Correcting drift..')
+            return
+        self.reloadedData()
+    
     def filterData(self):
         if self.histogramLayout.getCurrentIndex() == 0 and self.fileNameImage is not None: # the QT plot or nr loc per frame
             return # do nothing
+        if self.data is None: # no data loaded (yet)
+            return
 
         self.statusBusy('Filtering data..')
         # get the min reading
@@ -412,8 +662,17 @@ class SRVis(QMainWindow):
         dataType, histogram = self.getCurrentHistogram()
 
         self.filterValues[dataType] = (currentMin, currentMax)
-        self.data.filterData(self.filterValues)
+        # Filter in the background, a new filter value supersedes the previous one
+        self.jobs.submit('filterData', self.data.filterData, (dict(self.filterValues),),
+                         callback=self.filteredData,
+                         errorCallback=lambda error: self.statusFailed('Filtering data..'))
+    
+    def filteredData(self, result=None):
+        if self.data is None: # the data was closed in the meantime
+            return
         self.updateHistograms()
+        if isinstance(self.histogramLayout.getPage(), dataWidget): # update the statistics
+            self.changedHistogram(self.histogramLayout.getCurrentIndex())
         try:
             self.plotFrame.redraw()
         except: # errors can happen if there is no raw image specified, the image is not yet initialised etc.
@@ -437,14 +696,14 @@ class SRVis(QMainWindow):
         
     def updateHistograms(self):
         self.statusBusy('Updating histograms..')
-        self.localisationCount.setText( str(len(self.data.data.localisations(dataFilter=True))) )
+        self.localisationCount.setText( str(len(self.data.data.roiLocalisations(dataFilter=True))) )
         _, idxs = self.getHistogramIndex() # get the correct indexes
 
         # Update the histograms
         for idx in idxs:
             dataType = self.dataTypes[idx-idxs[0]] # start at zero
-            dataUnfiltered = self.data.data.localisations(dataFilter=False)[dataType]
-            dataFiltered   = self.data.data.localisations(dataFilter=True )[dataType]
+            dataUnfiltered = self.data.data.roiLocalisations(dataFilter=False)[dataType]
+            dataFiltered   = self.data.data.roiLocalisations(dataFilter=True )[dataType]
             
             histogram = self.histogramLayout.widget(idx)
             histogram.setData(dataUnfiltered, dataFiltered)
@@ -455,9 +714,9 @@ class SRVis(QMainWindow):
     
     def changedHistogram(self, idx):
         dataType, histogram = self.getCurrentHistogram()
-        dataFiltered   = self.data.data.localisations(dataFilter=True )[dataType]
+        dataFiltered   = self.data.data.roiLocalisations(dataFilter=True )[dataType]
         
-        self.filterMedian.setText( "%.2f" %np.median(dataFiltered) )
+        self.filterMedian.setText( "%.2f" %self.data.data.median(dataType) )
         self.filterMean.setText( "%.2f" %np.mean(dataFiltered) )
         self.filterStd.setText( "%.2f" %np.std(dataFiltered) )
         
@@ -497,12 +756,26 @@ class SRVis(QMainWindow):
     
     def clearAll(self):
         # Clear everything to create a fresh view
+        self.stopPlayback()
+        self.playbackInfo.clear()
+        
         # Clear the input fields
         self.HistBinSize.clear()
         self.QTscaleMin.clear()
         self.QTscaleMax.clear()
         self.QTHistBlur.setCheckState(Qt.Unchecked)
         self.QTBlurSigma.clear()
+        self.QTQuadTreeEps.clear()
+        self.QTQuadTreeUnit.clear()
+        self.QTGroupRadius.clear()
+        self.QTGroupGap.clear()
+        self.QTFiducialRadius.clear()
+        self.QTROIMode.blockSignals(True) # the old data is not updated
+        self.QTROIMode.setCurrentIndex(0)
+        self.QTROIMode.blockSignals(False)
+        self.QTDriftMode.blockSignals(True)
+        self.QTDriftMode.setCurrentIndex(0)
+        self.QTDriftMode.blockSignals(False)
         self.scalebar.clear()
         
         # Clear the TIFF image and remove the image histogram
@@ -544,8 +817,12 @@ class SRVis(QMainWindow):
 
     def showData(self, fileNameImage, fnameLocalisations, fnameLocalisationsType, pxSize, CpPh):
 
-        # Clear the previous data
+        # Clear the previous data. The old data is released right away, such
+        # that no action works on it while the new data is loading.
         self.clearAll()
+        if self.data is not None:
+            self.data.close() # stop reading ahead in the old image
+            self.data = None
         
         ## use for testing
 #        baseDirectory = './example/'
@@ -561,7 +838,14 @@ class SRVis(QMainWindow):
         if self.fileNameImage == '':
             self.fileNameImage = None
 
-        self.data = dataHandler(fileNameImage, fnameLocalisations, fnameLocalisationsType, pxSize, CpPh)
+        # Read the data in the background and set up the view once it is loaded
+        self.statusBusy('Loading data..')
+        self.jobs.submit('loadData', dataHandler, (fileNameImage, fnameLocalisations, fnameLocalisationsType, pxSize, CpPh),
+                         callback=self.showLoadedData,
+                         errorCallback=lambda error: self.statusFailed('Loading data..'))
+    
+    def showLoadedData(self, data):
+        self.data = data
         
         self.frame.setRange(0, self.data.maxImageFrame()-1)
         self.frameSlider.setMaximum(self.data.maxImageFrame()-1)
@@ -578,9 +862,14 @@ class SRVis(QMainWindow):
         
         # Get the data and plot the image histogram       
         d = np.asarray(self.data.data.localisations()[['x','y']])
-        self.QTHistogram   = imageHistogramWidget(d, title='2D Histogram', parent=self)
+        self.QTHistogram   = imageHistogramWidget(d, title='2D Histogram', parent=self, precision=self.imageHistogramPrecision(), \
+                                                  spatialIndex=self.data.data.spatialIndex)
         self.QTHistogram.setGaussianBlur(self.blurHistogram, self.sigma) # Update in case the checkbox has been toggled
-        self.QTHistogram.plot()
+        self.QTHistogram.setRenderMode(self.renderModes[self.QTRenderMode.currentIndex()][1])
+        self.QTHistogram.setQuadTreeParameters(self.quadTreeEps, self.quadTreeUnit / self.pxSize)
+        self.QTHistogram.setROIMode(self.roiModes[self.QTROIMode.currentIndex()][1])
+        self.QTHistogram.roiChanged.connect(self.changeROI)
+        self.changeImageHistogram(self.scaleMin, self.scaleMax, self.binSize)
         
         if self.fileNameImage is None: # no TIFF image available, show the histogram instead
             self.imageOverlay.addPage(self.QTHistogram, '')
@@ -629,6 +918,8 @@ class SRVis(QMainWindow):
         return
 
     def saveLocalisation(self):
+        if self.data is None: # no data loaded (yet)
+            return
         # Ast the user where to save the data
         path = QFileDialog.getSaveFileName(self, 'Save localisations to', self.home)
         
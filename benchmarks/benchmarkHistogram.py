@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+
+Compare the uniform bin histogram kernel with np.histogram2d.
+
+Usage: python benchmarks/benchmarkHistogram.py [nrPoints ...]
+
+By default 10^6, 10^7 and 10^8 points are histogrammed into bins of one
+pixel on a 512 x 512 pixel field of view. Note that 10^8 points need
+about 3 GB of memory.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from visualiseLocalisations import histogramUniform
+
+
+def timeIt(function, repeat=3):
+    """ Best wall clock time of repeat calls """
+    best = np.inf
+    for _ in xrange(repeat):
+        start = time.time()
+        result = function()
+        best = min(best, time.time() - start)
+    return best, result
+
+def benchmark(nrPoints, fieldOfView=512.0, binSize=1.0):
+    x = np.random.rand(nrPoints) * fieldOfView
+    y = np.random.rand(nrPoints) * fieldOfView
+    bins = (int(np.ceil((x.max() - x.min()) / binSize)), int(np.ceil((y.max() - y.min()) / binSize)))
+    
+    repeat = 1 if nrPoints >= 10**8 else 3
+    tNumpy,   (H1, xedges1, yedges1) = timeIt(lambda: np.histogram2d(x, y, bins=bins), repeat)
+    tUniform, (H2, xedges2, yedges2) = timeIt(lambda: histogramUniform(x, y, bins=bins), repeat)
+    
+    identical = np.array_equal(H1, H2) and np.array_equal(xedges1, xedges2) and np.array_equal(yedges1, yedges2)
+    print '%12d points  histogram2d %8.3f s  uniform %8.3f s  speedup %5.1fx  identical: %s' \
+          %(nrPoints, tNumpy, tUniform, tNumpy / tUniform, identical)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sizes = [ int(float(size)) for size in sys.argv[1:] ]
+    else:
+        sizes = [ 10**6, 10**7, 10**8 ]
+    
+    np.random.seed(0)
+    for nrPoints in sizes:
+        benchmark(nrPoints)
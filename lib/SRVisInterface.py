@@ -169,10 +169,11 @@ class openDialog(QDialog):
             CpPh = int(self.CountsPerPhoton.text())
 
         self.close() # check if this works..
+        # The data is loaded in the background, the main window updates the
+        # status once it is done.
         self.mainWindow.showData(fileNameImage, fnameLocalisations, fnameLocalisationsType, pxSize, CpPh)
 
         self.sendHome.emit(self.home)
-        self.mainWindow.statusReady()
 
 
 
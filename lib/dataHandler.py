@@ -21,9 +21,62 @@ import sys
 import numpy as np
 import tifffile as Tiff
 from localisationClass import rapidstormLocalisations, XYTLocalisations
+from frameCache import frameCache
 
 #from visualiseLocalisations import QuadTree
 
+
+def memmapTiffStack(tiff, fname):
+    """
+    Map an uncompressed TIFF stack directly into memory as (T, Y, X) array.
+    
+    This works if all pages are stored uncompressed and contiguous, have the
+    same shape and data type and are spaced at a constant distance in the
+    file, as is the case for typical raw camera acquisitions. Gaps between
+    the pages (e.g. the page headers) are skipped via the array strides, so
+    no data is copied. Returns None if the stack cannot be mapped and has to
+    be decoded page by page.
+    """
+    pages = tiff.pages
+    if len(pages) == 0:
+        return None
+    
+    first = pages[0]
+    if len(first.shape) != 2:
+        return None
+    dtype = np.dtype(first.dtype).newbyteorder(tiff.byteorder)
+    
+    offsets = list()
+    for page in pages:
+        contiguous = getattr(page, 'is_contiguous', None)
+        if not contiguous or page.shape != first.shape or page.dtype != first.dtype:
+            return None
+        if isinstance(contiguous, tuple): # older tifffile: (offset, bytecount)
+            offset, bytecount = contiguous
+        elif contiguous is True and getattr(page, 'dataoffsets', None):
+            offset, bytecount = page.dataoffsets[0], sum(page.databytecounts)
+        else:
+            return None
+        if bytecount != first.shape[0] * first.shape[1] * dtype.itemsize:
+            return None
+        offsets.append(offset)
+    
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(offsets) > 1:
+        stride = offsets[1] - offsets[0]
+        if stride < bytecount or np.any(np.diff(offsets) != stride):
+            return None
+    else:
+        stride = bytecount
+    
+    # Map the bytes from the first to the end of the last page and view them
+    # as stack of frames.
+    nrFrames = len(offsets)
+    buffer   = np.memmap(fname, dtype=np.uint8, mode='r', offset=offsets[0], \
+                         shape=(stride * (nrFrames - 1) + bytecount,))
+    return np.ndarray(shape=(nrFrames, ) + tuple(first.shape), dtype=dtype, buffer=buffer, \
+                      strides=(stride, first.shape[1] * dtype.itemsize, dtype.itemsize))
+
 class dataHandler():
     """
     Interface between the data and the SRVis application
@@ -38,48 +91,87 @@ class dataHandler():
         self.pixelSize = pixelSize
         self.CpPh = CpPh
 
+        self.imageStack = None
+        self.imageCache = None
         if fnameImage == None or fnameImage == '':
-            self.image = None
+            self.image      = None
         else:
             print 'Reading the image'
             self.image         = Tiff.TiffFile(fnameImage)
+            # Uncompressed stacks are mapped into memory, all others are
+            # decoded page by page. Decoded frames are kept in memory and the
+            # next frames are read ahead.
+            self.imageStack    = memmapTiffStack(self.image, fnameImage)
+            if self.imageStack is None:
+                self.imageCache = frameCache(self._readImage, len(self.image.pages))
         
         print 'Reading the localisations'
         self._loadLocalisations()
 
     def _loadLocalisations(self):
         # Here other localisation data types can be added if desired
+        # The data is only replaced once it is completely loaded, as it might
+        # be (re)loaded in a worker thread while the old data is still shown.
         if self.fnameLocalisationsType == 'rapidstorm':
-            self.data = rapidstormLocalisations()
-            self.data.readFile(self.fnameLocalisations, photonConversion=self.CpPh, pixelSize=self.pixelSize)
+            data = rapidstormLocalisations()
+            data.readFile(self.fnameLocalisations, photonConversion=self.CpPh, pixelSize=self.pixelSize)
         elif self.fnameLocalisationsType == 'xyt':
-            self.data = XYTLocalisations()
-            self.data.readFile(self.fnameLocalisations, pixelSize=self.pixelSize)
+            data = XYTLocalisations()
+            data.readFile(self.fnameLocalisations, pixelSize=self.pixelSize)
         else:
             print 'No localisation type is checked. Something went wrong..exiting'
             sys.exit() # Very ugly! Should be changed to a popup!
+        
+        # Build the per-frame lookup used when moving through the frames
+        data.frameLayout()
+        self.data = data
             
+    def close(self):
+        """ Stop reading ahead and close the TIFF file, call before the
+        dataHandler is replaced """
+        if self.imageCache is not None:
+            self.imageCache.close()
+        if self.image is not None:
+            self.image.close()
+    
     def reloadData(self, dataType):
         if dataType == 'localisations':
             self._loadLocalisations()
     
+    def _readImage(self, frame):
+        """ Decode the frame from the TIFF file """
+        return self.image.pages[frame].asarray()
+    
     def getImage(self, frame):
         """ Returns the frame as np.array """
-        return self.image[frame].asarray()
+        if self.imageStack is not None:
+            return self.imageStack[frame]
+        return self.imageCache[frame]
+    
+    def setPlaybackStep(self, step):
+        """ Read ahead every step-th frame during playback, None to follow the
+        direction in which the frames are accessed """
+        if self.imageCache is not None:
+            self.imageCache.step = step
+    
+    def getImageStack(self):
+        """ Returns the full image stack as (T, Y, X) array without copying the
+        data if the TIFF file could be memory mapped, None otherwise """
+        return self.imageStack
         
     def maxImageFrame(self):
         """ Returns the number of frames """
         if self.image == None:
             return 0
+        elif self.imageStack is not None:
+            return len(self.imageStack)
         else:
-            return len(self.image)
+            return len(self.imageCache)
         
     def getLocalisations(self, frame):
         """ Return X and Y localisation data as numpy arrays that can be 
         directly used in a matplotlib scatter plot """
-        data = self.data.localisations()
-        xy   = np.asarray(data[ data['frame'] == frame ][['x','y']])
-        return xy[:,0], xy[:,1]
+        return self.data.frameLocalisations(frame)
     
     def filterData(self, filterValues):
         """ Filter the localisation data based on the filter conditions in
@@ -91,9 +183,48 @@ class dataHandler():
             filterValues['SNR'] = (20, None)
         """
         self.data.filterAll(filterValues, relative=False)
+        self.data.frameLayout()
+        # Resolve the ROI here and not in the callback on the main thread,
+        # the unfiltered rows are cached already unless they were pruned
+        self.data.roiIndex(dataFilter=False)
+        self.data.roiIndex(dataFilter=True)
+    
+    def groupData(self, searchRadius, gapLength=0):
+        """ Group the localisations of the same emitter in subsequent frames
+        within searchRadius (in pixels), None to undo the grouping """
+        if searchRadius is None:
+            self.data.ungroupLocalisations()
+        else:
+            self.data.groupLocalisations(searchRadius, gapLength)
+        self.data.frameLayout()
+    
+    def detectFiducials(self, radius, minFrameFraction=0.5):
+        """ Search for fiducial markers of the given radius (in pixels) and
+        return how many were found """
+        return self.data.detectFiducials(radius, minFrameFraction)
+    
+    def correctDrift(self, method, **parameters):
+        """ Correct the drift with method 'fiducials' or 'rcc', None to undo
+        the correction. The parameters (lengths in pixels) are passed on to
+        the method, see localisations.correctDrift(). Returns False if the
+        drift could not be calculated. """
+        if method is None:
+            self.data.resetDrift()
+            success = True
+        else:
+            success = self.data.correctDrift(method, **parameters)
+        self.data.frameLayout()
+        return success
+    
+    def setROI(self, vertices):
+        """ Restrict the statistics and the export to the localisations inside
+        the polygon vertices (in pixels), None to use all localisations """
+        self.data.setROI(vertices)
+        self.data.roiIndex(dataFilter=False)
+        self.data.roiIndex(dataFilter=True)
     
     def saveLocalisations(self, fname, pxSize):
-        """ Save the (filtered) localisations to disk """
+        """ Save the (filtered) localisations inside the ROI to disk """
         self.data.writeToFile(fname, pixelSize=pxSize)
 
 
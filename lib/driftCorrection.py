@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+"""
+from itertools import combinations
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy.ndimage.filters import uniform_filter1d, median_filter
+from scipy.ndimage.fourier import fourier_gaussian
+from scipy.fftpack import next_fast_len
+
+
+def _interpolateFrames(frames, values, firstFrame, lastFrame):
+    """ Values for all frames from firstFrame to lastFrame by linear
+    interpolation, constant beyond the given frames """
+    allFrames = np.arange(firstFrame, lastFrame + 1)
+    return np.column_stack([ np.interp(allFrames, frames, values[:,axis]) for axis in (0, 1) ])
+
+
+def _fiducialPositions(x, y, frames, fiducial, nrFrames, trackLength=21, threshold=3.0):
+    """
+    Position of each fiducial in each frame as (2, nrFiducials, nrFrames)
+    array, NaN where it is missing. Of several localisations of a fiducial
+    in one frame the one nearest to its median track (the running median
+    over trackLength localisations) is taken. Localisations further from
+    the track than threshold times its robust spread are ignored.
+    """
+    nrFiducials = np.max(fiducial) + 1
+    order  = np.lexsort((frames, fiducial))
+    x, y   = x[order], y[order]
+    frames, fiducial = frames[order], fiducial[order]
+    bounds = np.searchsorted(fiducial, np.arange(nrFiducials + 1))
+
+    distance = np.zeros(len(x))
+    limit    = np.zeros(len(x))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if first == last:
+            continue
+        size = min(trackLength, last - first)
+        distance[first:last] = np.hypot(x[first:last] - median_filter(x[first:last], size=size, mode='nearest'), \
+                                        y[first:last] - median_filter(y[first:last], size=size, mode='nearest'))
+        limit[first:last] = threshold * 1.4826 * np.median(distance[first:last])
+
+    # The nearest of the accepted localisations of every fiducial and frame
+    cell = fiducial * nrFrames + frames
+    rows = np.lexsort((distance, cell))
+    rows = rows[ (distance[rows] <= limit[rows]) | (limit[rows] == 0) ]
+    _, first = np.unique(cell[rows], return_index=True)
+    rows = rows[first]
+
+    position = np.empty((2, nrFiducials, nrFrames))
+    position.fill(np.nan)
+    position[0].flat[cell[rows]] = x[rows]
+    position[1].flat[cell[rows]] = y[rows]
+    return position
+
+
+def fiducialDrift(x, y, frames, fiducial, firstFrame, lastFrame, smoothing=10):
+    """
+    Drift of each frame from the trajectories of the fiducial markers.
+
+    x, y, frames: positions and frames of the fiducial localisations
+    fiducial:     number of the fiducial of each localisation
+    smoothing:    length (in frames) of the moving average over the drift
+
+    The trajectory of each fiducial has one position per frame, the
+    localisation nearest to its median track (see _fiducialPositions). The
+    drift of a frame is the median displacement of the fiducials present in
+    it, after the constant offset of each fiducial was removed, such that a
+    single fiducial that is mislocalised does not shift the drift. Frames
+    without fiducial are interpolated.
+
+    Returns the drift (in the unit of x and y) of the frames firstFrame to
+    lastFrame as (nrFrames, 2) array, relative to firstFrame.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    frames   = np.asarray(frames, dtype=np.int64) - firstFrame
+    fiducial = np.asarray(fiducial, dtype=np.int64)
+    nrFrames = lastFrame - firstFrame + 1
+
+    position = _fiducialPositions(x, y, frames, fiducial, nrFrames)
+    present  = ~np.isnan(position[0])
+    covered  = np.flatnonzero(np.any(present, axis=0))
+    position = position[:, np.any(present, axis=1)][:, :, covered]
+
+    # Two passes: the drift from each fiducial relative to its median
+    # position, then the offsets of the fiducials relative to that drift.
+    # This removes the bias if the fiducials are present in different frames.
+    offset = np.nanmedian(position, axis=2)
+    for _ in xrange(2):
+        drift  = np.nanmedian(position - offset[:,:,None], axis=1)
+        offset = np.nanmedian(position - drift[:,None,:], axis=2)
+
+    drift = _interpolateFrames(covered + firstFrame, drift.T, firstFrame, lastFrame)
+    if smoothing > 1:
+        drift = uniform_filter1d(drift, int(smoothing), axis=0, mode='nearest')
+    return drift - drift[0]
+
+
+def _segmentImages(x, y, frames, segmentEdges, binSize, padding):
+    """ Real FFT of the 2D histogram of each time segment, zero padded """
+    mins  = np.array((np.min(x), np.min(y)))
+    bins  = ( (np.array((np.max(x), np.max(y))) - mins) // binSize ).astype(np.int64) + 1
+    shape = [ next_fast_len(int(n + padding)) for n in bins[::-1] ]
+    binX  = ((x - mins[0]) // binSize).astype(np.int64)
+    binY  = ((y - mins[1]) // binSize).astype(np.int64)
+    segment = np.searchsorted(segmentEdges, frames, side='right') - 1
+
+    images = list()
+    for i in xrange(len(segmentEdges) - 1):
+        inSegment = segment == i
+        image = np.zeros(shape, dtype=np.float64)
+        image[:bins[1],:bins[0]] = np.bincount(binY[inSegment] * bins[0] + binX[inSegment], \
+                                               minlength=np.prod(bins)).reshape(bins[1], bins[0])
+        # A slight blur gives a smooth correlation peak
+        images.append( fourier_gaussian(np.fft.rfft2(image), 1.0, n=shape[1]) )
+    return images, shape
+
+
+def _correlationPeak(Fi, Fj, shape, maxShift):
+    """
+    Shift (in bins, as (x, y)) of image j relative to image i from the
+    maximum of their cross-correlation within maxShift bins. The maximum is
+    refined by a parabola through the logarithm of it and its neighbours,
+    which is exact for a gaussian peak.
+    """
+    correlation = np.fft.irfft2(np.conj(Fi) * Fj, s=shape)
+    shifts = np.arange(-maxShift, maxShift + 1)
+    window = correlation[np.ix_(shifts % shape[0], shifts % shape[1])]
+    row, column = np.unravel_index(np.argmax(window), window.shape)
+
+    peak = list()
+    for index, profile in ((row, window[:,column]), (column, window[row,:])):
+        offset = 0.0
+        if 0 < index < len(profile) - 1:
+            left, centre, right = profile[index-1:index+2]
+            if min(left, centre, right) > 0:
+                left, centre, right = np.log((left, centre, right))
+            curvature = left - 2 * centre + right
+            if curvature < 0:
+                offset = 0.5 * (left - right) / curvature
+        peak.append(shifts[index] + offset)
+    return peak[1], peak[0]
+
+
+def rccDrift(x, y, frames, firstFrame, lastFrame, segments=10, binSize=0.25, maxShift=5.0, \
+             maxError=None, threads=None):
+    """
+    Drift of each frame by redundant cross-correlation (RCC).
+
+    The localisations are split into segments of equal frame ranges (at
+    most one per frame) and rendered as 2D histograms with bins of binSize.
+    The shift between every pair of segments is the maximum of their
+    cross-correlation (computed with FFTs, the pairs are processed on a
+    thread pool) within maxShift. The drift of the segments is the least
+    squares solution of all pairwise shifts, pairs with a residual above
+    maxError are discarded. The drift between the segment centres is
+    interpolated.
+
+    binSize, maxShift and maxError are given in the unit of x and y. A drift
+    of more than maxShift between any two segments is not found.
+
+    Returns the drift (in the unit of x and y) of the frames firstFrame to
+    lastFrame as (nrFrames, 2) array, relative to firstFrame.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    frames   = np.asarray(frames, dtype=np.int64)
+    nrFrames = lastFrame - firstFrame + 1
+    if nrFrames < 2:
+        return np.zeros((nrFrames, 2))
+    segments = max(min(int(segments), nrFrames), 2)
+    segmentEdges = np.linspace(firstFrame, lastFrame + 1, segments + 1)
+    maxShiftBins = int(np.ceil(maxShift / binSize))
+
+    images, shape = _segmentImages(x, y, frames, segmentEdges, binSize, maxShiftBins + 1)
+
+    pairs = list(combinations(range(segments), 2))
+    def correlatePair(pair):
+        i, j = pair
+        return _correlationPeak(images[i], images[j], shape, maxShiftBins)
+
+    if threads is None:
+        threads = cpu_count()
+    if threads > 1:
+        pool = ThreadPool(min(threads, len(pairs)))
+        try:
+            shifts = pool.map(correlatePair, pairs)
+        finally:
+            pool.close()
+    else:
+        shifts = map(correlatePair, pairs)
+    shifts = np.array(shifts) * binSize
+
+    # drift[j] - drift[i] = shift(i, j) with drift[0] = 0
+    A = np.zeros((len(pairs), segments - 1))
+    for row, (i, j) in enumerate(pairs):
+        if i > 0:
+            A[row, i-1] = -1
+        A[row, j-1] = 1
+    drift = np.linalg.lstsq(A, shifts, rcond=-1)[0]
+    if maxError is not None:
+        error = np.sqrt(np.sum((np.dot(A, drift) - shifts)**2, axis=1))
+        keep  = error <= maxError
+        if np.linalg.matrix_rank(A[keep]) == segments - 1: # all segments stay connected
+            drift = np.linalg.lstsq(A[keep], shifts[keep], rcond=-1)[0]
+    drift = np.vstack((np.zeros((1, 2)), drift))
+
+    # The drift is known at the segment centres, it is extrapolated linearly
+    # to the first and the last frame
+    centres = 0.5 * (segmentEdges[:-1] + segmentEdges[1:]) - 0.5
+    first   = drift[0]  + (drift[1]  - drift[0])  * (firstFrame - centres[0])  / (centres[1]  - centres[0])
+    last    = drift[-1] + (drift[-1] - drift[-2]) * (lastFrame  - centres[-1]) / (centres[-1] - centres[-2])
+    centres = np.concatenate(((firstFrame, ), centres, (lastFrame, )))
+    drift   = np.vstack((first, drift, last))
+    drift   = _interpolateFrames(centres, drift, firstFrame, lastFrame)
+    return drift - drift[0]
+
+
+def applyDrift(x, y, frames, drift, firstFrame, blockSize=2**22):
+    """
+    Subtract the drift of their frame from the positions x and y. The rows
+    are processed in blocks of blockSize to bound the temporary memory.
+
+    Returns the corrected x and y.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    correctedX = np.empty_like(x)
+    correctedY = np.empty_like(y)
+    for start in xrange(0, len(x), blockSize):
+        stop  = start + blockSize
+        frame = np.asarray(frames[start:stop], dtype=np.int64) - firstFrame
+        np.clip(frame, 0, len(drift) - 1, out=frame)
+        np.subtract(x[start:stop], drift[frame,0], out=correctedX[start:stop])
+        np.subtract(y[start:stop], drift[frame,1], out=correctedY[start:stop])
+    return correctedX, correctedY
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+"""
+import numpy as np
+from scipy.ndimage.filters import uniform_filter, maximum_filter, median_filter
+
+
+def _hotspots(x, y, binSize, minCount):
+    """
+    Centres of the bins of a coarse 2D histogram that are the maximum of
+    their 3x3 neighbourhood and whose neighbourhood holds at least minCount
+    localisations.
+    """
+    mins  = np.array((np.min(x), np.min(y)))
+    bins  = ( (np.array((np.max(x), np.max(y))) - mins) // binSize ).astype(np.int64) + 1
+    binX  = ((x - mins[0]) // binSize).astype(np.int64)
+    binY  = ((y - mins[1]) // binSize).astype(np.int64)
+    H     = np.bincount(binY * bins[0] + binX, minlength=np.prod(bins)).reshape(bins[1], bins[0])
+
+    # A spot close to a bin edge is spread over the neighbouring bins, the
+    # peaks are found on the histogram itself such that a dense structure
+    # next to the neighbourhood does not hide the spot
+    total = uniform_filter(H.astype(np.float64), size=3, mode='constant') * 9
+    peaks = (total >= minCount - 0.5) & (H == maximum_filter(H, size=3, mode='constant'))
+    row, column = np.nonzero(peaks)
+    return mins[0] + (column + 0.5) * binSize, mins[1] + (row + 0.5) * binSize
+
+
+def _trackFiducials(x, y, rows, offsets, startX, startY, startFrame, radius, forward=True, historyLength=25):
+    """
+    Follow the candidates through the frames (x, y and rows sorted by frame,
+    see findFiducials). In each frame a candidate takes the localisation
+    nearest to its running position (the median of its last historyLength
+    positions) if that is within radius. Going forward a candidate takes
+    part from its startFrame on, going backward only before its startFrame.
+
+    Returns the row of each candidate in each frame, -1 where none was taken.
+    """
+    nrCandidates = len(startX)
+    member   = np.empty((nrCandidates, len(offsets) - 1), dtype=np.int64)
+    member.fill(-1)
+    historyX = np.repeat(np.asarray(startX, dtype=np.float64)[:,None], historyLength, axis=1)
+    historyY = np.repeat(np.asarray(startY, dtype=np.float64)[:,None], historyLength, axis=1)
+    taken    = np.zeros(nrCandidates, dtype=np.int64) # to cycle through the history
+    positionX, positionY = startX.copy(), startY.copy()
+
+    frameOrder = np.arange(len(offsets) - 1)
+    if not forward:
+        frameOrder = frameOrder[::-1]
+    for frame in frameOrder:
+        start, stop = offsets[frame], offsets[frame+1]
+        if start == stop:
+            continue
+        active = np.flatnonzero(startFrame <= frame if forward else startFrame > frame)
+        if len(active) == 0:
+            continue
+
+        frameX, frameY = x[start:stop], y[start:stop]
+        distance = (positionX[active,None] - frameX)**2 + (positionY[active,None] - frameY)**2
+        nearest  = np.argmin(distance, axis=1)
+        found    = distance[np.arange(len(active)), nearest] <= radius**2
+        active, nearest = active[found], nearest[found]
+        if len(active) == 0:
+            continue
+
+        member[active, frame] = rows[start + nearest]
+        slot = taken[active] % historyLength
+        historyX[active, slot] = frameX[nearest]
+        historyY[active, slot] = frameY[nearest]
+        taken[active] += 1
+        positionX[active] = np.median(historyX[active], axis=1)
+        positionY[active] = np.median(historyY[active], axis=1)
+    return member
+
+
+def _rejectOutliers(x, y, rows, smoothing=11, threshold=3.0):
+    """
+    Drop the rows (sorted by frame) that are further from the running median
+    of the track than threshold times its robust spread. Returns the
+    remaining rows and the spread.
+    """
+    if len(rows) < 3:
+        return rows, 0.0
+    size = min(smoothing, len(rows))
+    residual = np.hypot(x[rows] - median_filter(x[rows], size=size, mode='nearest'), \
+                        y[rows] - median_filter(y[rows], size=size, mode='nearest'))
+    spread = 1.4826 * np.median(residual)
+    if spread <= 0:
+        return rows, spread
+    return rows[residual <= threshold * spread], spread
+
+
+def findFiducials(x, y, frames, index, radius=1.0, minFrameFraction=0.5, nrWindows=10):
+    """
+    Find the fiducial markers, i.e. spots that are localised in at least
+    minFrameFraction of all frames.
+
+    x, y, frames: positions and frames of the localisations
+    index:        spatialIndex.localisationIndex over x and y
+    radius:       radius of a fiducial spot (same unit as x and y), i.e. the
+                  distance a fiducial can move between two of its frames
+    nrWindows:    number of time windows searched for candidates
+
+    Candidates are the hotspots of a histogram with bins of 2*radius of the
+    localisations of each of the nrWindows time windows, such that a
+    fiducial is found even if it drifts further than radius during the
+    acquisition. Each candidate is then tracked forward and backward through
+    all frames, taking at most the one localisation per frame that is
+    nearest to the running position of the track. Localisations that
+    deviate from the smoothed track are rejected as outliers, as are tracks
+    that scatter by more than a third of the radius around it (i.e. the
+    radius should be about five times the localisation precision or more).
+    Candidates that mostly share their localisations with a better covered
+    one are dropped.
+
+    Returns the median position (M,2), the frame coverage of each fiducial
+    and the rows of the localisations that belong to it (list of index
+    arrays sorted by frame).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    frames = np.asarray(frames, dtype=np.int64)
+    if len(x) == 0:
+        return np.zeros((0, 2)), np.zeros(0), list()
+
+    firstFrame = np.min(frames)
+    nrFrames   = np.max(frames) - firstFrame + 1
+    nrWindows  = max(min(nrWindows, nrFrames), 1)
+    windows    = np.linspace(0, nrFrames, nrWindows + 1).astype(np.int64)
+
+    # The localisations sorted by frame
+    rows    = np.argsort(frames, kind='mergesort')
+    offsets = np.searchsorted(frames[rows], firstFrame + np.arange(nrFrames + 1))
+    sortedX = x[rows]
+    sortedY = y[rows]
+
+    # Candidates in each time window, centred on the localisations of the window
+    startX, startY, startFrame = list(), list(), list()
+    for first, last in zip(windows[:-1], windows[1:]):
+        windowRows = rows[offsets[first]:offsets[last]]
+        if len(windowRows) == 0:
+            continue
+        minCount = minFrameFraction * (last - first)
+        for cx, cy in zip(*_hotspots(x[windowRows], y[windowRows], 2.0 * radius, minCount)):
+            spot = index.queryRectangle(cx - 2*radius, cx + 2*radius, cy - 2*radius, cy + 2*radius)
+            for _ in xrange(2):
+                spot = spot[ (frames[spot] >= firstFrame + first) & (frames[spot] < firstFrame + last) ]
+                if len(spot) == 0:
+                    break
+                cx, cy = np.median(x[spot]), np.median(y[spot])
+                spot   = index.queryRadius(cx, cy, radius)
+            if len(spot) == 0:
+                continue
+            # A candidate already found in an earlier window is tracked once
+            if any( (cx - sx)**2 + (cy - sy)**2 < radius**2 for sx, sy in zip(startX, startY) ):
+                continue
+            startX.append(cx)
+            startY.append(cy)
+            startFrame.append(first)
+    if len(startX) == 0:
+        return np.zeros((0, 2)), np.zeros(0), list()
+
+    startX, startY = np.array(startX), np.array(startY)
+    startFrame     = np.array(startFrame, dtype=np.int64)
+    member   = _trackFiducials(sortedX, sortedY, rows, offsets, startX, startY, startFrame, radius)
+    backward = _trackFiducials(sortedX, sortedY, rows, offsets, startX, startY, startFrame, radius, forward=False)
+    member[backward >= 0] = backward[backward >= 0] # the passes cover different frames
+
+    candidates = list()
+    for track in member:
+        track, spread = _rejectOutliers(x, y, track[track >= 0])
+        coverage = len(track) / float(nrFrames)
+        # In dense regions a track can also be made up of the localisations
+        # of different emitters, these scatter over the whole radius (with a
+        # spread of about radius/2)
+        if coverage >= minFrameFraction and spread <= radius / 3.0:
+            candidates.append( (coverage, track) )
+
+    # Keep the best covered of the candidates that follow the same fiducial
+    candidates.sort(key=lambda candidate: -candidate[0])
+    used = np.zeros(len(x), dtype=bool)
+    centres, coverages, members = list(), list(), list()
+    for coverage, track in candidates:
+        if np.count_nonzero(used[track]) > 0.5 * len(track):
+            continue
+        track = track[~used[track]]
+        if len(track) < minFrameFraction * nrFrames:
+            continue
+        used[track] = True
+        centres.append( (np.median(x[track]), np.median(y[track])) )
+        coverages.append(len(track) / float(nrFrames))
+        members.append(track)
+    return np.array(centres).reshape(-1, 2), np.array(coverages), members
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+"""
+import threading
+from collections import OrderedDict
+
+
+class frameCache(object):
+    """
+    Bounded least-recently-used cache of decoded image frames.
+    
+    Every access schedules the next frames in the direction of travel to be
+    decoded by a background thread, so that playing through or scrubbing
+    back and forth in a region of the stack is served from memory.
+    
+    readFrame is a function that returns the decoded frame as np.array. It
+    is never called from two threads at the same time.
+    """
+    def __init__(self, readFrame, nrFrames, maxBytes=512*1024**2, readAhead=8):
+        """
+        readFrame:  function(frame) returning the frame as np.array
+        nrFrames:   number of frames in the stack
+        maxBytes:   upper bound of the memory used by the cached frames
+        readAhead:  number of frames that are decoded ahead of the current one
+        """
+        self.readFrame = readFrame
+        self.nrFrames  = nrFrames
+        self.maxBytes  = maxBytes
+        self.readAhead = readAhead
+        
+        self.frames    = OrderedDict() # frame -> np.array, oldest first
+        self.nbytes    = 0
+        self.lastFrame = None
+        self.step      = None # fixed read ahead step, e.g. during playback
+        
+        self.lock      = threading.Lock() # protects the cache content
+        self.readLock  = threading.Lock() # serialises the access to the file
+        
+        # The frames the prefetcher should decode next. A new request
+        # replaces the old one, so the prefetcher never works on outdated
+        # positions.
+        self.prefetchQueue     = list()
+        self.prefetchCondition = threading.Condition()
+        self.prefetchThread    = None
+        self.stopped           = threading.Event() # set by close()
+        if self.readAhead > 0:
+            self.prefetchThread = threading.Thread(target=self._prefetch)
+            self.prefetchThread.daemon = True
+            self.prefetchThread.start()
+    
+    def __len__(self):
+        return self.nrFrames
+    
+    def __getitem__(self, frame):
+        image = self._get(frame)
+        
+        # Read ahead in the direction of travel (forward if unknown)
+        if self.readAhead > 0:
+            if self.step is not None:
+                step = self.step
+            else:
+                step = -1 if self.lastFrame is not None and frame < self.lastFrame else 1
+            self._schedule( [ frame + step * i for i in range(1, self.readAhead+1) ] )
+        self.lastFrame = frame
+        return image
+    
+    def clear(self):
+        with self.lock:
+            self.frames = OrderedDict()
+            self.nbytes = 0
+    
+    def close(self):
+        """
+        Stop the prefetcher and drop the cached frames. The prefetch thread
+        holds a reference to readFrame (and whatever it is bound to), it
+        must be stopped before the image is replaced.
+        """
+        with self.prefetchCondition:
+            self.stopped.set()
+            self.prefetchQueue = list()
+            self.prefetchCondition.notify()
+        if self.prefetchThread is not None and self.prefetchThread is not threading.current_thread():
+            self.prefetchThread.join()
+        self.prefetchThread = None
+        self.clear()
+    
+    def _lookup(self, frame):
+        """ Return the cached frame and mark it as most recently used """
+        with self.lock:
+            image = self.frames.pop(frame, None)
+            if image is not None:
+                self.frames[frame] = image
+            return image
+    
+    def _get(self, frame):
+        image = self._lookup(frame)
+        if image is not None:
+            return image
+        
+        with self.readLock:
+            # The prefetcher might have decoded the frame in the meantime
+            image = self._lookup(frame)
+            if image is None:
+                image = self.readFrame(frame)
+                image.flags.writeable = False # cached frames are shared
+                self._insert(frame, image)
+        return image
+    
+    def _insert(self, frame, image):
+        with self.lock:
+            if frame in self.frames:
+                return
+            self.frames[frame] = image
+            self.nbytes += image.nbytes
+            # Drop the least recently used frames, but always keep the newest
+            while self.nbytes > self.maxBytes and len(self.frames) > 1:
+                _, oldImage = self.frames.popitem(last=False)
+                self.nbytes -= oldImage.nbytes
+    
+    def _schedule(self, frames):
+        frames = [ frame for frame in frames if 0 <= frame < self.nrFrames ]
+        with self.prefetchCondition:
+            self.prefetchQueue = frames
+            self.prefetchCondition.notify()
+    
+    def _prefetch(self):
+        while True:
+            with self.prefetchCondition:
+                while len(self.prefetchQueue) == 0 and not self.stopped.is_set():
+                    self.prefetchCondition.wait()
+                if self.stopped.is_set():
+                    return
+                frame = self.prefetchQueue.pop(0)
+            
+            with self.lock:
+                cached = frame in self.frames
+            if cached:
+                continue
+            try:
+                self._get(frame)
+            except Exception: # the frame will be read (and fail) again when requested
+                pass
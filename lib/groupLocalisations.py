@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def _matchNearest(sourceX, sourceY, targetX, targetY, radius):
+    """
+    Greedy one-to-one matching of the source to the target points within
+    radius, closest pairs first. Each source point is matched to its nearest
+    target point if that one is not taken by a closer source point.
+
+    Returns the matched source and target indices.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if len(sourceX) == 0 or len(targetX) == 0:
+        return empty, empty
+
+    tree = cKDTree(np.column_stack((targetX, targetY)))
+    distance, target = tree.query(np.column_stack((sourceX, sourceY)), k=1, distance_upper_bound=radius)
+
+    source = np.flatnonzero(target < len(targetX)) # inf distance if nothing is in range
+    source = source[np.argsort(distance[source], kind='mergesort')]
+    target = target[source]
+    _, first = np.unique(target, return_index=True) # keep the closest source per target
+    return source[first], target[first]
+
+
+def linkLocalisations(x, y, offsets, radius, gapLength=0):
+    """
+    Link the localisations of repeated blinks across frames.
+
+    x, y:      positions sorted by frame
+    offsets:   start of each frame in x and y, see localisations.frameLayout()
+    radius:    search radius (same unit as x and y)
+    gapLength: number of frames a blink may be missing within one track
+
+    A localisation continues the track whose last position is the nearest
+    within radius and that was last seen at most gapLength frames before.
+    All others start a new track. Only the localisations of consecutive
+    frames (up to gapLength frames apart) are compared, using a KD-tree of
+    each frame.
+
+    Returns the group of each localisation. The groups are numbered in the
+    order of their first localisation.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    offsets   = np.asarray(offsets, dtype=np.int64)
+    nrFrames  = len(offsets) - 1
+    gapLength = int(gapLength)
+
+    track    = np.empty(offsets[-1] - offsets[0], dtype=np.int64)
+    nrTracks = 0
+
+    # The last position and frame of the tracks that can still be continued
+    activeTrack = np.zeros(0, dtype=np.int64)
+    activeX     = np.zeros(0)
+    activeY     = np.zeros(0)
+    activeFrame = np.zeros(0, dtype=np.int64)
+
+    for frame in xrange(nrFrames):
+        start, stop = offsets[frame], offsets[frame+1]
+        if start == stop:
+            continue
+
+        # Forget the tracks that were not seen for too long
+        keep = activeFrame >= frame - gapLength - 1
+        if not np.all(keep):
+            activeTrack = activeTrack[keep]
+            activeX     = activeX[keep]
+            activeY     = activeY[keep]
+            activeFrame = activeFrame[keep]
+
+        frameX, frameY = x[start:stop], y[start:stop]
+        matched, points = _matchNearest(activeX, activeY, frameX, frameY, radius)
+
+        ids = np.empty(stop - start, dtype=np.int64)
+        ids.fill(-1)
+        ids[points] = activeTrack[matched]
+
+        # The remaining localisations start new tracks
+        new      = np.flatnonzero(ids < 0)
+        newIds   = nrTracks + np.arange(len(new), dtype=np.int64)
+        ids[new] = newIds
+        nrTracks += len(new)
+        track[start-offsets[0]:stop-offsets[0]] = ids
+
+        # Move the continued tracks and add the new ones
+        activeX[matched]     = frameX[points]
+        activeY[matched]     = frameY[points]
+        activeFrame[matched] = frame
+        activeTrack = np.concatenate((activeTrack, newIds))
+        activeX     = np.concatenate((activeX, frameX[new]))
+        activeY     = np.concatenate((activeY, frameY[new]))
+        activeFrame = np.concatenate((activeFrame, np.repeat(frame, len(new))))
+
+    return track
+
+
+def mergeGroups(data, group):
+    """
+    Merge the localisations of each group into one localisation.
+
+    data:  dict of column name -> array (sorted by frame)
+    group: group of each row, numbered in the order of the first row
+
+    The positions are averaged weighted with the inverse variance if the
+    uncertainties are available ('Uncertainty x/y'), with the photon count
+    otherwise. The uncertainties are combined accordingly, the photon counts
+    summed up and the frame of the first localisation is kept. All other
+    columns are averaged.
+
+    Returns a dict of column name -> array with one row per group.
+    """
+    group    = np.asarray(group, dtype=np.int64)
+    nrGroups = np.max(group) + 1 if len(group) > 0 else 0
+    count    = np.bincount(group, minlength=nrGroups).astype(np.float64)
+
+    def groupSum(values):
+        return np.bincount(group, weights=values, minlength=nrGroups)
+
+    # The first row of each group, the groups are numbered in order of appearance
+    firstRow = np.searchsorted(np.maximum.accumulate(group), np.arange(nrGroups))
+
+    weights = dict()
+    for axis, uncertainty in (('x', 'Uncertainty x'), ('y', 'Uncertainty y')):
+        if uncertainty in data:
+            weights[axis] = 1.0 / np.asarray(data[uncertainty], dtype=np.float64)**2
+        elif 'Photon Count' in data:
+            weights[axis] = np.asarray(data['Photon Count'], dtype=np.float64)
+        else:
+            weights[axis] = None
+
+    merged = dict()
+    for column in data:
+        values = np.asarray(data[column], dtype=np.float64)
+        if column in ('x', 'y') and weights[column] is not None:
+            merged[column] = groupSum(weights[column] * values) / groupSum(weights[column])
+        elif column in ('Uncertainty x', 'Uncertainty y'):
+            merged[column] = 1.0 / np.sqrt(groupSum(1.0 / values**2))
+        elif column == 'Photon Count':
+            merged[column] = groupSum(values)
+        elif column == 'frame':
+            merged[column] = values[firstRow]
+        else:
+            merged[column] = groupSum(values) / count
+    return merged
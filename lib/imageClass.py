@@ -16,6 +16,10 @@
 """
 SRVis  Copyright (C) 2015  Niklas Berliner
 """
+import time
+import copy
+from collections import OrderedDict
+
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -31,11 +35,13 @@ from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 #from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT
 
-from matplotlib.patches import Rectangle
+from matplotlib.patches import Rectangle, Polygon
 from matplotlib.figure import Figure
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
-from visualiseLocalisations import ImageHistogram
+
+from visualiseLocalisations import ImageHistogram, HistogramPyramid, QuadTree, histogramUniform
+from spatialIndex import gridIndex
 
 
 class NavigationToolbar(NavigationToolbar2QT):
@@ -74,7 +80,9 @@ class MyMatplotlibWidget(FigureCanvas):
 
 class imageHistogramWidget(MyMatplotlibWidget):
     
-    def __init__(self, data, title='Title', parent=None):
+    roiChanged = pyqtSignal(object) # ROI vertices (in pixels), None if removed
+    
+    def __init__(self, data, title='Title', parent=None, precision=None, spatialIndex=None):
         
         super(imageHistogramWidget, self).__init__(parent=parent, aspect='equal')
         self.toolbar = NavigationToolbar(self, self) # Why do I have to add it here again??
@@ -82,7 +90,8 @@ class imageHistogramWidget(MyMatplotlibWidget):
         assert(np.shape(data)[1] == 2)
         
         # Initialise some variables
-        self.data    = data
+        self.data      = data
+        self.precision = precision # localisation precision in x and y (in pixels)
         self.H       = None
         self.extent  = None
         self.binSize = 1
@@ -100,12 +109,91 @@ class imageHistogramWidget(MyMatplotlibWidget):
         
         self.get2DHistogram = ImageHistogram()   
         
-        # Connect the pan/zoom events to the scale bar update
-        self.axes.callbacks.connect('xlim_changed', self.updateScaleBar)
-        self.axes.callbacks.connect('ylim_changed', self.updateScaleBar)
+        # Computed histograms (H, extent), least recently used first. The
+        # key is (dataVersion, binSize, blur, sigma), the raw histogram is
+        # stored with blur=False such that it can be blurred again.
+        self.dataVersion         = 0
+        self.histogramCache      = OrderedDict()
+        self.histogramCacheBytes = 0
+        self.maxCacheBytes       = 256 * 1024**2
+        
+        # The render mode, see setRenderMode()
+        self.renderMode = 'histogram'
+        # The pyramid and the spatial index are kept for the data version they
+        # were built for. They are only replaced once the new ones are built,
+        # as the view might be rendered again in the meantime.
+        self.pyramid             = None
+        self.pyramidVersion      = None
+        self.spatialIndex        = None
+        self.spatialIndexVersion = None
+        self.spatialIndexSource  = spatialIndex # see setData()
+        self.viewScale  = None # auto scale of the view dependent modes
+        self.requestedScale = (None, None)
+        
+        # The quadtree is kept for the data version it was built for, its
+        # split criteria can be changed without sorting the points again
+        self.quadTree           = None
+        self.quadTreeVersion    = None
+        self.quadTreeEps        = 10
+        self.quadTreeUnitLength = 0.1 # in pixels
+        
+        # View dependent modes are rendered again once panning/zooming
+        # came to rest
+        self.viewTimer = QTimer()
+        self.viewTimer.setSingleShot(True)
+        self.viewTimer.setInterval(150)
+        self.viewTimer.timeout.connect(self.renderCurrentView)
+        
+        # Connect the pan/zoom events to the scale bar and view update
+        self.axes.callbacks.connect('xlim_changed', self.viewChanged)
+        self.axes.callbacks.connect('ylim_changed', self.viewChanged)
+        
+        # The region of interest is drawn with the mouse, see setROIMode()
+        self.roiMode     = None
+        self.roi         = None   # vertices of the finished ROI
+        self.roiVertices = list() # vertices of the ROI that is being drawn
+        self.roiPatch    = None
+        self.mpl_connect('button_press_event',   self.roiPress)
+        self.mpl_connect('motion_notify_event',  self.roiMotion)
+        self.mpl_connect('button_release_event', self.roiRelease)
     
-    def setData(self, data):
-        self.data = data
+    # Render modes that depend on the current view limits
+    viewModes = ('pyramid', 'rebin', 'quadtree')
+    
+    def setData(self, data, precision=None, spatialIndex=None):
+        """ Set the (N,2) positions to show. spatialIndex can be a callable
+        returning an existing spatial index over the same positions, which
+        is then used by the 'rebin' mode instead of building its own. """
+        self.data      = data
+        self.precision = precision
+        self.spatialIndexSource = spatialIndex
+        self.dataVersion += 1 # the cached histograms are outdated
+        self.H       = None # make sure the histogram is recalculated
+    
+    def setRenderMode(self, mode):
+        """
+        Select how the localisations are rendered:
+            'histogram': one 2D histogram of all localisations at binSize
+            'pyramid':   tile pyramid, only the visible tiles are rendered at
+                         the resolution matching the screen
+            'rebin':     the localisations inside the view are binned again
+                         with bins matching the screen pixels
+            'quadtree':  adaptive bins from a quadtree (see
+                         setQuadTreeParameters), rasterised at the resolution
+                         matching the screen
+            'splat':     each localisation is rendered as a gaussian with its
+                         own localisation precision (falls back to the
+                         histogram if no precision is available)
+        """
+        assert( mode in ('histogram', 'splat') + self.viewModes )
+        if mode != self.renderMode:
+            self.renderMode = mode
+            self.H          = None
+    
+    def viewChanged(self, args):
+        self.updateScaleBar(args)
+        if self.renderMode in self.viewModes and self.im is not None:
+            self.viewTimer.start() # restarting the timer debounces the update
     
     def setScalebarLength(self, length):
         self.scalebarLength = length
@@ -179,19 +267,306 @@ class imageHistogramWidget(MyMatplotlibWidget):
 #        self.draw()
         self.toolbar.dynamic_update() # This seems to slightly faster than self.draw()
 
-    def setGaussianBlur(self, blur, sigma):
-        self.get2DHistogram.setGaussianBlur(blur, sigma)
+    def setGaussianBlur(self, blur, sigma, backend=None):
+        self.get2DHistogram.setGaussianBlur(blur, sigma, backend)
+    
+    @property
+    def blurInfo(self):
+        """ (backend, seconds) of the last gaussian blur, None if the blurred
+        histogram came from the cache or no blur was applied """
+        return self.get2DHistogram.blurInfo
+    
+    def cachedHistogram(self, binSize, kind='raw'):
+        """
+        The 2D histogram (H, extent) of the current data. Results are kept in
+        a small LRU cache, so switching back to a previous bin size or
+        toggling the blur does not compute the histogram again.
+        
+        kind: 'raw' histogram, 'blur' for the gaussian blurred histogram or
+              'splat' for the gaussian rendering with the precision
+        """
+        sigma = (self.get2DHistogram.sigma, self.get2DHistogram.blurBackend) if kind == 'blur' else None
+        key   = (self.dataVersion, binSize, kind, sigma)
+        
+        result = self.histogramCache.pop(key, None)
+        if result is None:
+            if kind == 'blur':
+                H, extent = self.cachedHistogram(binSize, 'raw')
+                result = (self.get2DHistogram.blur(H), extent)
+            elif kind == 'splat':
+                start  = time.time()
+                result = self.get2DHistogram.gaussianRendering(self.data, self.precision, binSize)
+                self.get2DHistogram.blurInfo = ('per localisation', time.time() - start)
+            else:
+                result = self.get2DHistogram.histogram(self.data, binSize)
+            self.histogramCacheBytes += result[0].nbytes
+        self.histogramCache[key] = result # (re)insert as most recently used
+        
+        # Drop the least recently used histograms, always keep the new one
+        while self.histogramCacheBytes > self.maxCacheBytes and len(self.histogramCache) > 1:
+            _, (H, _) = self.histogramCache.popitem(last=False)
+            self.histogramCacheBytes -= H.nbytes
+        return result
     
     def calculate2DHistogram(self, scaleMin, scaleMax, binSize=1):
-        self.H, self.extent, self.sm, scaleMin, scaleMax = self.get2DHistogram(self.data, scaleMin, scaleMax, binSize)
+        # The color scale is determined from the raw histogram (or from the
+        # gaussian rendering which has a different intensity scale)
+        splat = self.renderMode == 'splat' and self.precision is not None
+        if splat:
+            H, self.extent = self.cachedHistogram(binSize, 'splat')
+        else:
+            H, self.extent = self.cachedHistogram(binSize)
+        color, scaleMin, scaleMax = self.get2DHistogram._setColorBar(H, scaleMin, scaleMax)
+        self.sm = color.getColorbar()
+        self.sm._A = [] # fake up the array of the scalar mappable
+        
+        if self.get2DHistogram.gaussianFilter and not splat:
+            H, self.extent = self.cachedHistogram(binSize, 'blur')
+        self.H = H
         return scaleMin, scaleMax
     
     def plot(self, scaleMin=None, scaleMax=None, binSize=1, blur=True):
-        if self.H is None or self.binSize != binSize or self.scaleMin != scaleMin or self.scaleMax != scaleMax:
-            self.binSize = binSize
-            self.scaleMin, self.scaleMax = self.calculate2DHistogram(scaleMin, scaleMax, binSize=binSize)
-
-
+        self.updateHistogram(scaleMin, scaleMax, binSize)
+        self.drawHistogram()
+    
+    def updateHistogram(self, scaleMin=None, scaleMax=None, binSize=1):
+        """ Recalculate the 2D histogram if needed. Does not touch the figure
+        and can therefore be run outside of the Qt main thread. """
+        self.get2DHistogram.blurInfo = None
+        if self.renderMode == 'pyramid':
+            if self.pyramid is None or self.pyramidVersion != self.dataVersion or self.binSize != binSize:
+                pyramid             = HistogramPyramid(self.data, binSize)
+                self.binSize        = binSize
+                self.pyramid        = pyramid
+                self.pyramidVersion = self.dataVersion
+                self.viewScale      = None
+            self.requestedScale = (scaleMin, scaleMax)
+            return
+        elif self.renderMode == 'rebin':
+            if self.spatialIndex is None or self.spatialIndexVersion != self.dataVersion:
+                if self.spatialIndexSource is not None:
+                    self.spatialIndex    = self.spatialIndexSource()
+                else:
+                    self.spatialIndex    = gridIndex(self.data)
+                self.spatialIndexVersion = self.dataVersion
+                self.viewScale           = None
+            elif self.binSize != binSize:
+                self.viewScale    = None
+            self.binSize        = binSize
+            self.requestedScale = (scaleMin, scaleMax)
+            return
+        elif self.renderMode == 'quadtree':
+            if self.quadTree is None or self.quadTreeVersion != self.dataVersion:
+                self.quadTree        = QuadTree(self.data, self.quadTreeEps, self.quadTreeUnitLength)
+                self.quadTreeVersion = self.dataVersion
+                self.viewScale       = None
+            elif self.quadTree.eps != self.quadTreeEps or self.quadTree.unitArea != self.quadTreeUnitLength**2:
+                # The shown tree might be rendered in the meantime, the leaves
+                # are derived on a copy (_run() replaces the leaf arrays, the
+                # sorted points are shared) that is swapped in afterwards.
+                quadTree = copy.copy(self.quadTree)
+                quadTree.setParameters(self.quadTreeEps, self.quadTreeUnitLength)
+                self.quadTree  = quadTree
+                self.viewScale = None
+            elif self.binSize != binSize:
+                self.viewScale = None
+            self.binSize        = binSize
+            self.requestedScale = (scaleMin, scaleMax)
+            return
+        
+        self.binSize = binSize
+        self.scaleMin, self.scaleMax = self.calculate2DHistogram(scaleMin, scaleMax, binSize=binSize)
+    
+    def setQuadTreeParameters(self, eps=None, unitLength=None):
+        """
+        eps:        maximum number of localisations in a quadtree bin
+        unitLength: minimum edge length of a quadtree bin (in pixels)
+        The new values are used by the next updateHistogram().
+        """
+        if eps is not None:
+            self.quadTreeEps = eps
+        if unitLength is not None:
+            self.quadTreeUnitLength = unitLength
+    
+    def setROIMode(self, mode):
+        """
+        Select how a region of interest is drawn:
+            None:        no ROI, a present ROI is removed
+            'rectangle': press and drag the mouse
+            'polygon':   click the vertices, close the polygon with a
+                         double click or the right mouse button
+        The ROI can only be drawn while pan/zoom of the toolbar is inactive.
+        """
+        assert( mode in (None, 'rectangle', 'polygon') )
+        self.roiMode     = mode
+        self.roiVertices = list()
+        if mode is None:
+            self.clearROI()
+    
+    def clearROI(self):
+        """ Remove the ROI from the image """
+        self.roiVertices = list()
+        self._drawROI(None)
+        if self.roi is not None:
+            self.roi = None
+            self.roiChanged.emit(None)
+    
+    def _roiEvent(self, event):
+        """ True if the mouse event is meant for drawing the ROI """
+        return self.roiMode is not None and event.inaxes is self.axes and not self.toolbar.mode
+    
+    def roiPress(self, event):
+        if not self._roiEvent(event):
+            return
+        point = (event.xdata, event.ydata)
+        if self.roiMode == 'rectangle':
+            self.roiVertices = [point, point]
+        elif event.button == 3 or event.dblclick: # close the polygon
+            self._finishROI(self.roiVertices)
+        else:
+            self.roiVertices.append(point)
+            self._drawROI(self.roiVertices + [point], closed=False)
+    
+    def roiMotion(self, event):
+        if not self.roiVertices or not self._roiEvent(event):
+            return
+        point = (event.xdata, event.ydata)
+        if self.roiMode == 'rectangle':
+            self.roiVertices[1] = point
+            self._drawROI(self._rectangleVertices(*self.roiVertices))
+        else: # show the next edge of the polygon
+            self._drawROI(self.roiVertices + [point], closed=False)
+    
+    def roiRelease(self, event):
+        if self.roiMode != 'rectangle' or not self.roiVertices:
+            return
+        if self._roiEvent(event):
+            self.roiVertices[1] = (event.xdata, event.ydata)
+        self._finishROI(self._rectangleVertices(*self.roiVertices))
+    
+    def _rectangleVertices(self, start, stop):
+        (x0, y0), (x1, y1) = start, stop
+        return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    
+    def _finishROI(self, vertices):
+        """ Keep the ROI if it encloses an area, otherwise remove it """
+        self.roiVertices = list()
+        vertices = np.asarray(vertices, dtype=np.float64)
+        if len(vertices) < 3 or np.any(np.ptp(vertices, axis=0) == 0):
+            self.clearROI()
+            return
+        self.roi = vertices
+        self._drawROI(vertices)
+        self.roiChanged.emit(vertices)
+    
+    def _drawROI(self, vertices, closed=True):
+        """ Show the (unfinished) ROI outline, None removes it """
+        if self.roiPatch is not None:
+            self.roiPatch.remove()
+            self.roiPatch = None
+        if vertices is not None:
+            self.roiPatch = self.axes.add_patch( Polygon(vertices, closed=closed, fill=False, \
+                                                         edgecolor='cyan', linewidth=1.5, zorder=10) )
+        self.draw_idle()
+    
+    def viewStructure(self):
+        """ The pyramid, quadtree or spatial index used by the current
+        render mode, None if it was not built yet """
+        if self.renderMode == 'pyramid':
+            return self.pyramid
+        elif self.renderMode == 'quadtree':
+            return self.quadTree
+        else:
+            return self.spatialIndex
+    
+    def viewBounds(self):
+        """ The data boundaries in a view dependent mode """
+        structure = self.viewStructure()
+        return structure.mins, structure.maxs
+    
+    def quadTreeView(self, xlim, ylim, pixels):
+        """
+        Rasterise the quadtree leaves inside the view with one pixel per
+        screen pixel. The densities are scaled to counts per area of
+        binSize x binSize, like in rebinView().
+        """
+        pixelSize = max(abs(xlim[1] - xlim[0]) / max(pixels[0], 1), abs(ylim[1] - ylim[0]) / max(pixels[1], 1))
+        H, extent = self.quadTree.rasterise(pixelSize, xlim, ylim)
+        H *= self.binSize**2
+        return H, extent
+    
+    def rebinView(self, xlim, ylim, pixels):
+        """
+        Bin the localisations inside the view with one bin per screen pixel.
+        The values are scaled to counts per area of binSize x binSize, i.e.
+        the color scale does not depend on the zoom level.
+        """
+        xmin, xmax = sorted(xlim)
+        ymin, ymax = sorted(ylim)
+        # Square bins matching the screen pixels
+        pixelSize = max((xmax - xmin) / max(pixels[0], 1), (ymax - ymin) / max(pixels[1], 1))
+        binsX = max(int(np.ceil((xmax - xmin) / pixelSize)), 1)
+        binsY = max(int(np.ceil((ymax - ymin) / pixelSize)), 1)
+        xmax  = xmin + binsX * pixelSize
+        ymax  = ymin + binsY * pixelSize
+        
+        x, y = self.spatialIndex.pointsInRectangle(xmin, xmax, ymin, ymax)
+        H, _, _ = histogramUniform(y, x, bins=(binsY, binsX), range=[[ymin, ymax], [xmin, xmax]])
+        H *= (self.binSize / pixelSize)**2
+        return H, [xmin, xmax, ymax, ymin]
+    
+    def renderView(self):
+        """ Render the current view limits in a view dependent mode """
+        xlim   = self.axes.get_xlim()
+        ylim   = self.axes.get_ylim()
+        pixels = (self.axes.bbox.width, self.axes.bbox.height)
+        if self.renderMode == 'pyramid':
+            H, extent = self.pyramid.render(xlim, ylim, pixels)
+        elif self.renderMode == 'quadtree':
+            H, extent = self.quadTreeView(xlim, ylim, pixels)
+        else:
+            H, extent = self.rebinView(xlim, ylim, pixels)
+        
+        # The blur sigma is given in units of binSize
+        if self.get2DHistogram.gaussianFilter:
+            renderedBinSize = (extent[1] - extent[0]) / float(np.shape(H)[1])
+            H = self.get2DHistogram.blur(H, self.get2DHistogram.sigma * self.binSize / renderedBinSize)
+        return H, extent
+    
+    def renderCurrentView(self):
+        """ Update the image after the view limits changed """
+        if self.renderMode not in self.viewModes or self.im is None:
+            return
+        if self.viewStructure() is None: # still being built by updateHistogram()
+            return
+        self.H, self.extent = self.renderView()
+        self.im.set_data(self.H)
+        self.im.set_extent(self.extent)
+        self.redraw()
+    
+    def drawHistogram(self):
+        """ Show the current 2D histogram in the figure """
+        if self.renderMode in self.viewModes:
+            if self.viewStructure() is None: # still being built by updateHistogram()
+                return
+            if self.im is None: # Show all data in the first view
+                mins, maxs = self.viewBounds()
+                self.axes.set_xlim(mins[0], maxs[0])
+                self.axes.set_ylim(maxs[1], mins[1])
+            self.H, self.extent = self.renderView()
+            
+            # The auto scale is determined once per data set, such that it
+            # does not change while zooming.
+            scaleMin, scaleMax = self.requestedScale
+            if self.viewScale is not None:
+                scaleMin = self.viewScale[0] if scaleMin is None else scaleMin
+                scaleMax = self.viewScale[1] if scaleMax is None else scaleMax
+            color, self.scaleMin, self.scaleMax = self.get2DHistogram._setColorBar(self.H, scaleMin, scaleMax)
+            if self.viewScale is None:
+                self.viewScale = (self.scaleMin, self.scaleMax)
+            self.sm = color.getColorbar()
+            self.sm._A = []
+        
         if self.colorbar is not None:
             # Thanks to: http://stackoverflow.com/a/5265614
             self.fig.delaxes(self.fig.axes[1])
@@ -201,8 +576,10 @@ class imageHistogramWidget(MyMatplotlibWidget):
         # and only the data is updated after the first image has been plotted.
         if self.im is None:
             self.im = self.axes.imshow(self.H, extent=self.extent, interpolation='nearest', origin='upper', cmap='gist_heat')
+            self.axes.set_autoscale_on(False) # a new extent should not reset the view
         else:
             self.im.set_data(self.H)
+            self.im.set_extent(self.extent)
         norm = matplotlib.colors.Normalize(vmin=self.scaleMin, vmax=self.scaleMax)
         self.im.set_norm(norm)
 
@@ -223,28 +600,56 @@ class overlayWidget(MyMatplotlibWidget):
         
         self.data = data
 
-        # Set some axes properties
-        self.axes.invert_yaxis() # the origin of the images is in the top left corner
-        if self.data is not None:
-            self.initialise()
-        
         # Initialse some variables
-        self.im      = None
-        self.loc     = None
+        self.im         = None
+        self.loc        = None
+        self.background = None # the static part of the figure used for blitting
         
         self.markerSize   = 40
         self.lw           = 1
         self.currentFrame = 0
+        
+        # Store the background whenever the full figure is drawn, e.g. after
+        # resizing, zooming or panning.
+        self.canvas.mpl_connect('draw_event', self.storeBackground)
+
+        # Set some axes properties
+        self.axes.invert_yaxis() # the origin of the images is in the top left corner
+        if self.data is not None:
+            self.initialise()
     
     def reset(self):
         self.axes.cla()
         self.axes.relim()
         self.axes.autoscale()
-#        self.loc     = None # This creates a problem that the first loc are not removed.. I don't understand why
-        self.im      = None
+        self.loc        = None # the scatter is removed from the axes by cla()
+        self.im         = None
+        self.background = None
     
     def updateView(self):
         self.canvas.draw()
+    
+    def storeBackground(self, event=None):
+        # The image and the localisations are animated artists, i.e. they are
+        # not part of the full draw and have to be added on top.
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.drawAnimated()
+    
+    def drawAnimated(self):
+        if self.im is not None:
+            self.axes.draw_artist(self.im)
+        if self.loc is not None:
+            self.axes.draw_artist(self.loc)
+    
+    def blitView(self):
+        """ Redraw only the image and the localisations on top of the stored
+        background instead of rendering the full figure """
+        if self.background is None or not getattr(self.canvas, 'supports_blit', False):
+            self.updateView()
+            return
+        self.canvas.restore_region(self.background)
+        self.drawAnimated()
+        self.canvas.blit(self.axes.bbox)
         
     def initialise(self):
         self.drawFirstImage()
@@ -263,7 +668,7 @@ class overlayWidget(MyMatplotlibWidget):
         if self.im is not None: # the image is already initialised
             return
         imageData = self.data.getImage(0)
-        self.im  = self.axes.imshow(imageData, interpolation='none', origin='upper', cmap = plt.cm.Greys_r)
+        self.im  = self.axes.imshow(imageData, interpolation='none', origin='upper', cmap = plt.cm.Greys_r, animated=True)
         return
     
     def updateImage(self, frame):
@@ -275,15 +680,17 @@ class overlayWidget(MyMatplotlibWidget):
         return
     
     def plotFirstLocalisations(self):
-        X, Y = self.data.getLocalisations(0)
-        self.loc = self.axes.scatter(x=X, y=Y, facecolors='none', edgecolors='blue', s=self.markerSize, zorder=200)
+        self.updateLocalisations(0)
         return
         
     def updateLocalisations(self, frame):
         X, Y = self.data.getLocalisations(frame)
-        if self.loc is not None:
-            self.loc.remove()
-        self.loc = self.axes.scatter(x=X, y=Y, facecolors='none', edgecolors='blue', s=self.markerSize, zorder=200)
+        if self.loc is None:
+            self.loc = self.axes.scatter(x=X, y=Y, facecolors='none', edgecolors='blue', s=self.markerSize, zorder=200, animated=True)
+        else:
+            # Reuse the existing collection and only update the positions
+            self.loc.set_offsets(np.column_stack((X, Y)))
+            self.loc.set_sizes([self.markerSize])
         return
     
     def redraw(self, frame=None):
@@ -292,7 +699,7 @@ class overlayWidget(MyMatplotlibWidget):
         assert( isinstance(frame, int) )
         self.updateImage(frame)
         self.updateLocalisations(frame)
-        self.updateView()
+        self.blitView()
         return
 
 
@@ -326,6 +733,13 @@ class dataWidget(MyMatplotlibWidget):
         self.data = np.asarray(data)
         self.dataUnfiltered = np.asarray(dataUnfiltered)
         
+        # The number of localisations changes with the ROI
+        self.normaliseUnfiltered = np.zeros(np.shape(self.dataUnfiltered))
+        self.normaliseUnfiltered[:,] = 1.0/self.normalise
+        if len(self.dataUnfiltered) == 0: # e.g. no localisations in the ROI
+            self.bins = None
+            return
+        
         dataMin = np.min(self.dataUnfiltered)
         dataMax = np.max(self.dataUnfiltered)
         binwidth = ( dataMax - dataMin ) / 50.0
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+"""
+import traceback
+
+from PyQt4.QtCore import *
+
+
+class jobThread(QThread):
+    """
+    Worker thread that runs the submitted jobs one after the other. Only the
+    latest job per key is kept in the queue, i.e. a job that did not start
+    yet is dropped if a new job with the same key is submitted.
+    """
+    jobDone = pyqtSignal(object, int, object, object) # key, jobId, result, error
+    
+    def __init__(self, parent=None):
+        super(jobThread, self).__init__(parent)
+        
+        self.mutex     = QMutex()
+        self.condition = QWaitCondition()
+        self.queue     = list() # (key, jobId, function, args, kwargs)
+        self.stopped   = False
+    
+    def submit(self, key, jobId, function, args, kwargs):
+        self.mutex.lock()
+        # Drop the superseded job and queue the new one at the end to keep
+        # the order of submission between different keys.
+        self.queue = [ job for job in self.queue if job[0] != key ]
+        self.queue.append( (key, jobId, function, args, kwargs) )
+        self.condition.wakeOne()
+        self.mutex.unlock()
+    
+    def stop(self):
+        self.mutex.lock()
+        self.stopped = True
+        self.queue   = list()
+        self.condition.wakeOne()
+        self.mutex.unlock()
+        self.wait()
+    
+    def run(self):
+        while True:
+            self.mutex.lock()
+            while len(self.queue) == 0 and not self.stopped:
+                self.condition.wait(self.mutex)
+            if self.stopped:
+                self.mutex.unlock()
+                return
+            key, jobId, function, args, kwargs = self.queue.pop(0)
+            self.mutex.unlock()
+            
+            try:
+                result, error = function(*args, **kwargs), None
+            except Exception:
+                result, error = None, traceback.format_exc()
+            self.jobDone.emit(key, jobId, result, error)
+
+
+class jobRunner(QObject):
+    """
+    Runs long computations (loading, filtering, histograms) off the Qt main
+    thread and hands the result to a callback that is executed in the main
+    thread, where it is safe to update the widgets.
+    
+    Jobs submitted with the same key supersede each other: a pending job is
+    dropped and the result of a running one is discarded. Quickly repeated
+    edits therefore lead to only one update of the user interface.
+    """
+    def __init__(self, parent=None):
+        super(jobRunner, self).__init__(parent)
+        
+        self.jobId  = 0
+        self.latest = dict() # key -> (jobId, callback, errorCallback)
+        
+        # The signal is emitted from the worker thread and is therefore
+        # delivered as queued connection in the main thread.
+        self.thread = jobThread()
+        self.thread.jobDone.connect(self._jobDone)
+        self.thread.start()
+    
+    def submit(self, key, function, args=(), kwargs=None, callback=None, errorCallback=None):
+        """
+        Run function(*args, **kwargs) in the worker thread and call
+        callback(result) once it finished, or errorCallback(traceback) if it
+        raised an exception.
+        """
+        if kwargs is None:
+            kwargs = dict()
+        self.jobId += 1
+        self.latest[key] = (self.jobId, callback, errorCallback)
+        self.thread.submit(key, self.jobId, function, tuple(args), kwargs)
+        return self.jobId
+    
+    def isBusy(self, key=None):
+        """ Check if a job (with the given key) is pending or running """
+        if key is None:
+            return len(self.latest) > 0
+        return key in self.latest
+    
+    def stop(self):
+        self.latest = dict()
+        self.thread.stop()
+    
+    @pyqtSlot(object, int, object, object)
+    def _jobDone(self, key, jobId, result, error):
+        latest = self.latest.get(key)
+        if latest is None or latest[0] != jobId: # the job was superseded
+            return
+        del self.latest[key]
+        
+        _, callback, errorCallback = latest
+        if error is not None:
+            print error
+            if errorCallback is not None:
+                errorCallback(error)
+        elif callback is not None:
+            callback(result)
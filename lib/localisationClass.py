@@ -16,9 +16,11 @@
 """
 SRVis  Copyright (C) 2015  Niklas Berliner
 """
-from copy import deepcopy
-
 from readLocalisations  import *
+from spatialIndex       import localisationIndex
+from groupLocalisations import linkLocalisations, mergeGroups
+from fiducials          import findFiducials
+from driftCorrection    import fiducialDrift, rccDrift, applyDrift
 
 class localisations():
     
@@ -39,6 +41,7 @@ class localisations():
         self.fiducials            = None
         
         self.driftCalculated             = False
+        self.driftMethod                 = None # see correctDrift()
         self.drift                       = None
         self.driftCorrectedData          = None
         self.driftCorrectedDataFiltered  = None
@@ -46,19 +49,32 @@ class localisations():
         self.driftCorrectedDataUngroupedFiltered = None
         
         self.gapLength = 0
+        
+        self.frameLayouts = dict() # per-frame offset index, see frameLayout()
+        
+        self.filterBounds = dict() # (min, max) for each filtered column
+        self.filterMasks  = dict() # cached boolean masks, see _updateFilterMasks()
+        
+        self.useSortedIndex = True   # use sorted column indices for range filters
+        self.sortedIndices  = dict() # cached argsort per column, see sortedIndex()
+        
+        self.spatialIndices = dict() # cached grid and KD-tree, see spatialIndex()
+        
+        self.roi        = None   # polygon vertices (in pixels) of the region of interest
+        self.roiIndices = dict() # cached rows inside the ROI, see roiIndex()
     
     def localisations(self, dataType=None, dataFilter=True):
         doFilter = self.filtered and dataFilter
         if dataType == None:
             if doFilter:
-                if self.driftCalculated and self.fiducialsDetected:
+                if self.driftCalculated:
                     return self.driftCorrectedDataFiltered
                 elif self.grouped:
                     return self.groupedDataFiltered
                 else:
                     return self.dataFiltered
             else:
-                if self.driftCalculated and self.fiducialsDetected:
+                if self.driftCalculated:
                     return self.driftCorrectedData
                 elif self.grouped:
                     return self.groupedData
@@ -96,14 +112,14 @@ class localisations():
         doFilter = self.filtered and dataFilter
         if dataType == None:
             if doFilter:
-                if self.driftCalculated and self.fiducialsDetected:
+                if self.driftCalculated:
                     return 'self.driftCorrectedDataFiltered'
                 elif self.grouped:
                     return 'self.groupedDataFiltered'
                 else:
                     return 'self.dataFiltered'
             else:
-                if self.driftCalculated and self.fiducialsDetected:
+                if self.driftCalculated:
                     return 'self.driftCorrectedData'
                 elif self.grouped:
                     return 'self.groupedData'
@@ -147,6 +163,285 @@ class localisations():
         nrLocalisations = np.asarray(data.groupby('frame').count().x.values)
         return frames, (nrLocalisations, perFrames)
 
+    def frameLayout(self, dataType=None, dataFilter=True):
+        """
+        Return the x and y positions as contiguous arrays sorted by frame
+        together with the first frame and an offset array. The localisations
+        of frame f are x[start:stop] and y[start:stop] with
+        
+            start, stop = offsets[f-firstFrame], offsets[f-firstFrame+1]
+        
+        The layout is computed once per DataFrame and reused until the data
+        is replaced, e.g. by filtering.
+        """
+        data = self.localisations(dataType=dataType, dataFilter=dataFilter)
+        name = self.queryLocalisations(dataType=dataType, dataFilter=dataFilter)
+        
+        layout = self.frameLayouts.get(name)
+        if layout is not None and layout[0] is data:
+            return layout[1]
+        
+        frames = np.asarray(data['frame'], dtype=np.int64)
+        x      = np.asarray(data['x'])
+        y      = np.asarray(data['y'])
+        if np.any(frames[1:] < frames[:-1]): # make sure the frames are sorted
+            order  = np.argsort(frames, kind='mergesort')
+            frames = frames[order]
+            x      = x[order]
+            y      = y[order]
+        x = np.ascontiguousarray(x)
+        y = np.ascontiguousarray(y)
+        
+        if len(frames) == 0:
+            firstFrame, offsets = 0, np.zeros(1, dtype=np.int64)
+        else:
+            firstFrame = frames[0]
+            offsets    = np.searchsorted(frames, np.arange(firstFrame, frames[-1]+2))
+        
+        self.frameLayouts[name] = (data, (x, y, firstFrame, offsets))
+        return x, y, firstFrame, offsets
+    
+    def frameLocalisations(self, frame, dataType=None, dataFilter=True):
+        """ Return the x and y positions of one frame as views into the frame layout """
+        x, y, firstFrame, offsets = self.frameLayout(dataType=dataType, dataFilter=dataFilter)
+        idx = frame - firstFrame
+        if idx < 0 or idx >= len(offsets) - 1:
+            return x[:0], y[:0]
+        start, stop = offsets[idx], offsets[idx+1]
+        return x[start:stop], y[start:stop]
+
+    def spatialIndex(self, dataType=None, dataFilter=True):
+        """
+        Return the spatial index (see spatialIndex.localisationIndex) over the
+        x and y positions of the data. Rectangle and radius queries on the
+        index return row indices into localisations(dataType, dataFilter).
+        
+        The index is built on first use and reused until the data is replaced,
+        e.g. by filtering or drift correction.
+        """
+        data = self.localisations(dataType=dataType, dataFilter=dataFilter)
+        name = self.queryLocalisations(dataType=dataType, dataFilter=dataFilter)
+        
+        cached = self.spatialIndices.get(name)
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        
+        index = localisationIndex(np.column_stack((np.asarray(data['x'], dtype=np.float64), \
+                                                   np.asarray(data['y'], dtype=np.float64))))
+        self.spatialIndices[name] = (data, index)
+        return index
+    
+    def setROI(self, vertices=None):
+        """
+        Restrict the statistics and the export to the localisations inside the
+        polygon given by its (N,2) vertices (in pixels). None removes the ROI.
+        """
+        if vertices is not None:
+            vertices = np.array(vertices, dtype=np.float64)
+            assert( vertices.ndim == 2 and vertices.shape[1] == 2 and len(vertices) >= 3 )
+        self.roi        = vertices
+        self.roiIndices = dict()
+    
+    def roiIndex(self, dataType=None, dataFilter=True):
+        """
+        The rows of localisations(dataType, dataFilter) inside the ROI, sorted
+        ascending. None if no ROI is set. The rows are found with the spatial
+        index and cached until the data or the ROI changes.
+        """
+        if self.roi is None:
+            return None
+        data = self.localisations(dataType=dataType, dataFilter=dataFilter)
+        name = self.queryLocalisations(dataType=dataType, dataFilter=dataFilter)
+        
+        cached = self.roiIndices.get(name)
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        
+        rows = self.spatialIndex(dataType=dataType, dataFilter=dataFilter).queryPolygon(self.roi)
+        self.roiIndices[name] = (data, rows)
+        return rows
+    
+    def roiLocalisations(self, dataType=None, dataFilter=True):
+        """ As localisations() but restricted to the ROI if one is set """
+        data = self.localisations(dataType=dataType, dataFilter=dataFilter)
+        rows = self.roiIndex(dataType=dataType, dataFilter=dataFilter)
+        if rows is None:
+            return data
+        return data.iloc[rows]
+    
+    def groupLocalisations(self, searchRadius, gapLength=None):
+        """
+        Link the localisations of the same emitter in subsequent frames and
+        merge each chain into one localisation (see groupLocalisations.py).
+        
+        searchRadius: maximum distance between linked localisations (in pixels)
+        gapLength:    number of frames an emitter may be missing within one
+                      chain, self.gapLength is used if None
+        
+        The merged localisations are used as grouped data.
+        """
+        if gapLength is not None:
+            self.gapLength = int(gapLength)
+        
+        # Link the positions in the frame layout and bring all other columns
+        # into the same order
+        data = self.data
+        x, y, firstFrame, offsets = self.frameLayout(dataType='original', dataFilter=False)
+        frames = np.asarray(data['frame'], dtype=np.int64)
+        order  = None
+        if np.any(frames[1:] < frames[:-1]): # the order used by frameLayout()
+            order = np.argsort(frames, kind='mergesort')
+        columns = dict()
+        for column in data.columns:
+            values = np.asarray(data[column])
+            columns[column] = values if order is None else values[order]
+        
+        group  = linkLocalisations(x, y, offsets, searchRadius, self.gapLength)
+        merged = mergeGroups(columns, group)
+        
+        # The grouped data is complete before the grouped flag selects it,
+        # the data might be shown in the meantime
+        groupedData = DataFrame(merged, columns=data.columns, index=frameIndex(merged['frame']))
+        self.groupedDataFiltered = self._filterData('grouped', groupedData)
+        self.groupedData         = groupedData
+        self.linkedLocalisations = True
+        if self.driftCalculated: # correct the grouped data as well
+            self._applyDrift(grouped=True)
+        self.grouped = True
+        self._pruneCaches()
+    
+    def ungroupLocalisations(self):
+        """ Use the localisations as they are, without grouping """
+        if self.driftCalculated:
+            self._applyDrift(grouped=False)
+        self.linkedLocalisations = False
+        self.grouped             = False
+        self.groupedData         = None
+        self.groupedDataFiltered = None
+        self._pruneCaches()
+    
+    def detectFiducials(self, radius=1.0, minFrameFraction=0.5):
+        """
+        Search the original localisations for fiducial markers, i.e. spots
+        of the given radius (in pixels) that are localised in at least
+        minFrameFraction of all frames (see fiducials.findFiducials).
+        
+        The localisations of the fiducials are stored in self.fiducials with
+        the number of their fiducial in the column 'fiducial'.
+        """
+        data  = self.data
+        index = self.spatialIndex(dataType='original', dataFilter=False)
+        centres, coverage, members = findFiducials(data['x'], data['y'], data['frame'], index, \
+                                                   radius=radius, minFrameFraction=minFrameFraction)
+        
+        if len(members) > 0:
+            rows     = np.concatenate(members)
+            fiducial = np.repeat(np.arange(len(members)), [ len(m) for m in members ])
+        else:
+            rows     = np.zeros(0, dtype=np.int64)
+            fiducial = np.zeros(0, dtype=np.int64)
+        order = np.argsort(rows, kind='mergesort') # keep the frame order of the data
+        
+        self.fiducials = data.iloc[rows[order]].copy()
+        self.fiducials['fiducial'] = fiducial[order]
+        self.fiducialsSearchedFor  = True
+        self.fiducialsDetected     = len(members) > 0
+        return len(members)
+    
+    def correctDrift(self, method='fiducials', **parameters):
+        """
+        Calculate the drift of the sample and correct the localisations.
+        
+        method: 'fiducials' uses the trajectories of the detected fiducials
+                (see detectFiducials()), 'rcc' the redundant cross-correlation
+                of the original localisations
+        
+        The parameters are passed on to driftCorrection.fiducialDrift() or
+        driftCorrection.rccDrift(), lengths are given in pixels. The drift (in
+        pixels) of each frame is stored in self.drift. Returns False if it
+        could not be calculated, the previous correction is kept then.
+        """
+        frames = np.asarray(self.data['frame'], dtype=np.int64)
+        if len(frames) == 0:
+            return False
+        firstFrame, lastFrame = np.min(frames), np.max(frames)
+        
+        if method == 'fiducials':
+            if not self.fiducialsDetected:
+                print 'Warning: No fiducials detected, the drift cannot be calculated!'
+                return False
+            fiducials = self.fiducials
+            drift = fiducialDrift(fiducials['x'], fiducials['y'], fiducials['frame'], fiducials['fiducial'], \
+                                  firstFrame, lastFrame, **parameters)
+        elif method == 'rcc':
+            drift = rccDrift(self.data['x'], self.data['y'], frames, firstFrame, lastFrame, **parameters)
+        else: # we should never reach this point
+            print 'Warning: Drift correction method not understood!'
+            return False
+        
+        # The corrected data is complete before the flag selects it
+        drift = DataFrame({ 'frame' : np.arange(firstFrame, lastFrame + 1),
+                            'x'     : drift[:,0],
+                            'y'     : drift[:,1] }, columns=['frame', 'x', 'y'])
+        self._applyDrift(drift=drift)
+        self.drift           = drift
+        self.driftMethod     = method
+        self.driftCalculated = True
+        return True
+    
+    def resetDrift(self):
+        """ Use the localisations without drift correction """
+        self.driftCalculated                     = False
+        self.driftMethod                         = None
+        self.drift                               = None
+        self.driftCorrectedData                  = None
+        self.driftCorrectedDataFiltered          = None
+        self.driftCorrectedDataUngrouped         = None
+        self.driftCorrectedDataUngroupedFiltered = None
+        self._pruneCaches()
+    
+    def _applyDrift(self, grouped=None, drift=None):
+        """
+        Correct the ungrouped and the grouped localisations for the drift
+        (self.drift if None). The grouped localisations are corrected with
+        the drift of their first frame. grouped overrides self.grouped, e.g.
+        while the grouping changes.
+        """
+        if grouped is None:
+            grouped = self.grouped
+        if drift is None:
+            drift = self.drift
+        firstFrame = int(drift['frame'].iloc[0])
+        drift      = np.asarray(drift[['x','y']])
+        
+        def corrected(data):
+            x, y = applyDrift(np.asarray(data['x']), np.asarray(data['y']), \
+                              np.asarray(data['frame']), drift, firstFrame)
+            # Only x and y change, the other columns are shared if pandas
+            # allows it. The new columns are inserted rather than assigned,
+            # older pandas versions write an assignment into the shared block.
+            data = data.copy(deep=False)
+            for name, values in (('x', x), ('y', y)):
+                position = list(data.columns).index(name)
+                del data[name]
+                data.insert(position, name, values)
+            return data
+        
+        # All variants are corrected before any of them is replaced
+        ungrouped = corrected(self.data)
+        if grouped:
+            correctedData = corrected(self.groupedData)
+        else:
+            correctedData = ungrouped
+        ungroupedFiltered = self._filterData('driftCorrectedUngrouped', ungrouped)
+        correctedFiltered = self._filterData('driftCorrected', correctedData)
+        
+        self.driftCorrectedDataUngrouped         = ungrouped
+        self.driftCorrectedDataUngroupedFiltered = ungroupedFiltered
+        self.driftCorrectedData                  = correctedData
+        self.driftCorrectedDataFiltered          = correctedFiltered
+        self._pruneCaches()
+    
     def _getXYT(self, data):
         """ Get the x,y,t data from the DataFrame """
         x = np.array(data['x'])
@@ -160,26 +455,64 @@ class localisations():
         self.groupedData                 = self.groupedDataFiltered
         self.driftCorrectedData          = self.driftCorrectedDataFiltered
         self.driftCorrectedDataUngrouped = self.driftCorrectedDataUngroupedFiltered
+        self._pruneCaches()
+    
+    # The filterable data variants and their (unfiltered, filtered) attributes
+    filterVariants = { 'original'                : ('data',                        'dataFiltered'),
+                       'grouped'                 : ('groupedData',                 'groupedDataFiltered'),
+                       'driftCorrected'          : ('driftCorrectedData',          'driftCorrectedDataFiltered'),
+                       'driftCorrectedUngrouped' : ('driftCorrectedDataUngrouped', 'driftCorrectedDataUngroupedFiltered') }
+    
+    def _activeFilterVariants(self):
+        """ The data variants that are currently present and need filtering """
+        variants = ['original', ]
+        if self.grouped:
+            variants.append('grouped')
+        if self.driftCalculated:
+            variants.extend(['driftCorrected', 'driftCorrectedUngrouped'])
+        return variants
     
     def filterAll(self, filterValues, relative=False):
         """
         Filter the data based on the criteria in filterValues.
+        
+        Only the criteria that changed since the last call are evaluated
+        again, the masks of the remaining columns are reused.
         """
         assert( isinstance(filterValues, dict) )
-        self.filterLocalisations() # This resets the filter
-        for dataType in filterValues: # This applies the new filters
+        # Remove the criteria that are no longer used
+        for dataType in list(self.filterBounds.keys()):
+            if dataType not in filterValues:
+                del self.filterBounds[dataType]
+        
+        for dataType in filterValues: # This sets the new filters
             minValue, maxValue = filterValues[dataType]
-            self.filterLocalisations(minValue, maxValue, dataType, relative)
+            self._setFilterBounds(minValue, maxValue, dataType, relative)
+        
+        self._applyFilters()
 
     def filterLocalisations(self, minValue=None, maxValue=None, dataType=None, \
                             relative=True, overwrite=False):
         """ minValue and maxValue are taken as percentage values of the maxium 
         value. Supress via relative=False
+        
+        Each column holds one criterion, i.e. filtering a column again replaces
+        its previous bounds. Calling without arguments resets all filters.
         """
         if minValue==None and maxValue==None and dataType==None: #reset filter
-            self.filtered = False
-            return       
+            self.filtered     = False
+            self.filterBounds = dict()
+            return
+        
+        self._setFilterBounds(minValue, maxValue, dataType, relative)
+        self._applyFilters()
         
+        if overwrite:
+            self._overwriteDataWithFiltered()
+        return
+    
+    def _setFilterBounds(self, minValue, maxValue, dataType, relative):
+        """ Convert the filter values to absolute bounds and store them """
         # Set the minimum filter value
         if minValue == None:
             minValue = - np.inf
@@ -188,8 +521,6 @@ class localisations():
                 if minValue > 1.0: # it was given as e.g. 20%
                     minValue /= 100.0
                 minValue = self.data[dataType].max() * minValue
-            else:
-                minValue = minValue
 
         # Set the maximum filter value
         if maxValue == None:
@@ -199,41 +530,150 @@ class localisations():
                 if maxValue > 1.0: #it was given as e.g. 20%
                     maxValue /= 100.0
                 maxValue = self.data[dataType].max() * maxValue
-            else:
-                maxValue = maxValue
-
-        ## The following is a bit ugly. I am keeping track of the applied
-        ## filter/modifactions to compare the individual steps.
-        if self.filtered: # apply additional filter
-            d   = deepcopy(self.dataFiltered)
-        else: # filter from the original data
-            d   = deepcopy(self.data)
-        self.dataFiltered                   = deepcopy(d[   (  d[dataType] >= minValue) & (  d[dataType] <= maxValue) ])
         
-        if self.grouped:
-            if self.filtered: # apply additional filter
-                gd  = deepcopy(self.groupedDataFiltered)
-            else:
-                gd  = deepcopy(self.groupedData)
-            self.groupedDataFiltered        = deepcopy(gd[  ( gd[dataType] >= minValue) & ( gd[dataType] <= maxValue) ])
-
+        self.filterBounds[dataType] = (minValue, maxValue)
+    
+    def _updateFilterMasks(self, variant, data=None):
+        """
+        Return the combined boolean filter mask for the unfiltered data of the
+        given variant. The mask of each column is cached together with its
+        bounds and only recomputed if the bounds or the data changed.
+        
+        data replaces the data of the variant, e.g. before it is stored.
+        """
+        if data is None:
+            data = getattr(self, self.filterVariants[variant][0])
+        
+        cached = self.filterMasks.get(variant)
+        if cached is None or cached[0] is not data: # new data, start over
+            cached = (data, dict())
+            self.filterMasks[variant] = cached
+        columnMasks = cached[1]
         
-        if self.driftCalculated and self.fiducialsDetected:
-            if self.filtered: # apply additional filter
-                dgd = deepcopy(self.driftCorrectedDataFiltered)
-                dd  = deepcopy(self.driftCorrectedDataUngroupedFiltered)
+        # Forget the masks of columns that are no longer filtered
+        for dataType in list(columnMasks.keys()):
+            if dataType not in self.filterBounds:
+                del columnMasks[dataType]
+        
+        mask = None
+        for dataType, (minValue, maxValue) in self.filterBounds.items():
+            if minValue == -np.inf and maxValue == np.inf: # nothing to filter
+                columnMasks.pop(dataType, None)
+                continue
+            if dataType not in columnMasks or columnMasks[dataType][0] != (minValue, maxValue):
+                columnMasks[dataType] = ( (minValue, maxValue), self._rangeMask(variant, dataType, minValue, maxValue, data) )
+            if mask is None:
+                mask = columnMasks[dataType][1].copy()
             else:
-                dgd = deepcopy(self.driftCorrectedData)
-                dd  = deepcopy(self.driftCorrectedDataUngrouped)
-            self.driftCorrectedDataFiltered = deepcopy(dgd[ (dgd[dataType] >= minValue) & (dgd[dataType] <= maxValue) ])
-            self.driftCorrectedDataUngroupedFiltered = deepcopy(dd[ (dd[dataType] >= minValue) & (dd[dataType] <= maxValue) ])
+                mask &= columnMasks[dataType][1]
+        return mask
+    
+    def _rangeMask(self, variant, dataType, minValue, maxValue, data=None):
+        """ Boolean mask of the rows of column dataType within [minValue, maxValue] """
+        if data is None:
+            data = getattr(self, self.filterVariants[variant][0])
+        if not self.useSortedIndex:
+            column = np.asarray(data[dataType])
+            return (column >= minValue) & (column <= maxValue)
         
+        # Two binary searches in the sorted column give the range of rows
+        # that pass, which are then marked via the argsort index.
+        order, sortedValues = self.sortedIndex(dataType, variant, data)
+        start = np.searchsorted(sortedValues, minValue, side='left')
+        stop  = np.searchsorted(sortedValues, maxValue, side='right')
+        mask  = np.zeros(len(order), dtype=bool)
+        mask[order[start:stop]] = True
+        return mask
+    
+    def sortedIndex(self, dataType, variant='original', data=None):
+        """
+        Return the argsort of column dataType of the unfiltered data variant
+        (or of data in its place) together with the sorted column values. The
+        index is built on first use and cached until the data changes. NaN
+        values are sorted to the end.
+        """
+        if data is None:
+            data = getattr(self, self.filterVariants[variant][0])
+        cached = self.sortedIndices.get((variant, dataType))
+        if cached is not None and cached[0] is data:
+            return cached[1], cached[2]
+        
+        column = np.asarray(data[dataType])
+        order  = np.argsort(column, kind='mergesort')
+        if len(order) < np.iinfo(np.int32).max: # halve the memory of the index
+            order = order.astype(np.int32)
+        sortedValues = column[order]
+        
+        self.sortedIndices[(variant, dataType)] = (data, order, sortedValues)
+        return order, sortedValues
+    
+    def _pruneCaches(self):
+        """
+        Drop the cached layouts, masks and indices of DataFrames that are no
+        longer one of the data variants, so that replaced data can be freed.
+        """
+        current = [ getattr(self, name) for names in self.filterVariants.values() for name in names ]
+        current = [ data for data in current if data is not None ]
+        def isCurrent(data):
+            return any( data is other for other in current )
+        
+        for cache in (self.frameLayouts, self.filterMasks, self.sortedIndices, \
+                      self.spatialIndices, self.roiIndices):
+            for key in [ key for key, value in cache.items() if not isCurrent(value[0]) ]:
+                del cache[key]
+    
+    def _defaultVariant(self):
+        """ The data variant returned by localisations() if no dataType is given """
+        if self.driftCalculated:
+            return 'driftCorrected'
+        elif self.grouped:
+            return 'grouped'
+        else:
+            return 'original'
+    
+    def median(self, column, dataType=None, dataFilter=True):
+        """
+        The median of column in the (filtered) data. If the sorted column
+        index was already built for the range filters the value is read from
+        it, otherwise np.median() (a partial sort) is cheaper than building it.
+        """
+        variant = self._defaultVariant() if dataType is None else dataType
+        cached  = self.sortedIndices.get((variant, column))
+        if self.roi is not None or cached is None or cached[0] is not getattr(self, self.filterVariants[variant][0]):
+            return np.median(np.asarray(self.roiLocalisations(dataType, dataFilter)[column]))
+        order, sortedValues = cached[1], cached[2]
+        
+        mask = self.filterMask(variant) if dataFilter else None
+        if mask is not None:
+            sortedValues = sortedValues[mask[order]]
+        
+        N = len(sortedValues)
+        if N == 0 or np.isnan(sortedValues[-1]): # same result as np.median
+            return np.nan
+        return 0.5 * (sortedValues[(N-1)//2] + sortedValues[N//2])
+    
+    def filterMask(self, dataType='original'):
+        """ The combined filter mask of a data variant, None if nothing is filtered """
+        if not self.filtered:
+            return None
+        return self._updateFilterMasks(dataType)
+    
+    def _filterData(self, variant, data):
+        """ Apply the combined filter mask of the variant to its (new)
+        unfiltered data, data itself if nothing is filtered """
+        mask = self._updateFilterMasks(variant, data)
+        if mask is None: # all rows pass, no need to copy anything
+            return data
+        return data[mask]
+    
+    def _applyFilters(self):
+        """ Apply the combined filter mask to all data variants """
+        for variant in self._activeFilterVariants():
+            unfilteredName, filteredName = self.filterVariants[variant]
+            setattr(self, filteredName, self._filterData(variant, getattr(self, unfilteredName)))
         
-        if overwrite:
-            self._overwriteDataWithFiltered()
-            
         self.filtered = True # set the filtered flag
-        return
+        self._pruneCaches()
 
     def writeToFile(self, fname, dataType=None, pixelSize=1.0):
         if dataType == None:
@@ -248,6 +688,9 @@ class localisations():
             data = self.localisations('driftCorrectedUngrouped')
         elif dataType == 'fiducials':
             data = self.fiducials
+        
+        if self.roi is not None and dataType != 'fiducials': # only export the ROI
+            data = data.iloc[self.roiIndex(dataType)].copy()
 
         try:
             # Convert data to nm and save to disk
@@ -263,12 +706,19 @@ class rapidstormLocalisations(localisations):
     def __init__(self):
         localisations.__init__(self)
 
-    def readFile(self, fname, photonConversion=1.0, pixelSize=1.0):
-        self.data = readRapidStormLocalisations(fname, photonConversion, pixelSize)
+    def readFile(self, fname, photonConversion=1.0, pixelSize=1.0, useCache=True):
+        if useCache:
+            self.data = readCachedLocalisations(readRapidStormLocalisations, fname, \
+                                                photonConversion=photonConversion, pixelSize=pixelSize)
+        else:
+            self.data = readRapidStormLocalisations(fname, photonConversion, pixelSize)
             
     def frame(self, frame):
+        # Support the old 'frame_N' labels for backwards compatibility
+        if isinstance(frame, str) and frame.startswith('frame_'):
+            frame = int(frame[len('frame_'):])
         assert( isinstance(frame, int) )
-        return self.data.ix['frame_'+str(frame)]
+        return self.data.loc[frame]
 
     def allPoints(self):
         for point in self.data.iterrows():
@@ -285,12 +735,15 @@ class XYTLocalisations(localisations):
     def __init__(self):
         localisations.__init__(self)
 
-    def readFile(self, fname, pixelSize):
+    def readFile(self, fname, pixelSize, useCache=True):
         """
         The first row is used as header information, the following columns must
         be present: 'x', 'y', and 'frame' (note: this is case sensitive!)
         """
-        self.data = readXYTLocalisations(fname, pixelSize=pixelSize)
+        if useCache:
+            self.data = readCachedLocalisations(readXYTLocalisations, fname, pixelSize=pixelSize)
+        else:
+            self.data = readXYTLocalisations(fname, pixelSize=pixelSize)
 
 
 
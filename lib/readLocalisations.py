@@ -17,34 +17,94 @@
 SRVis  Copyright (C) 2015  Niklas Berliner
 """
 
+import os
+import json
+import tempfile
 import xml.etree.ElementTree as ET
 import numpy as np
-from pandas import DataFrame
+from pandas import DataFrame, MultiIndex, read_csv
 
-class indexGenerator():
+def frameIndex(frames):
     """
-    Generates an increasing index for each localisation based on the frame
-    number. Assumes the frames to be ordered. For use with pandas multiindex
-    DataFrames
+    Generates the two level index for the localisations based on the frame
+    number, i.e. the frame and an increasing index within each frame. Assumes
+    the frames to be ordered. For use with pandas multiindex DataFrames.
+    
+    The index is built in one vectorised pass over the frame column: the
+    position within a frame is the row number minus the row number at which
+    the current run of equal frames started.
     """
-    def __init__(self):
-        self.currentFrame  = 0
-        self.previousFrame = 0
-        self.idx           = -1
-
-    def __call__(self, frame):
-        if frame == self.currentFrame:
-            self.idx += 1
-            return self.idx
-        else:
-            # Update the frames
-            self.previousFrame = self.currentFrame
-            self.currentFrame  = frame
-            self.idx = 0
-            return self.idx
-
-
-def readRapidStormLocalisations(fname, photonConversion=1.0, pixelSize=1.0):
+    frames   = np.asarray(frames).astype(np.int64)
+    rowCount = len(frames)
+    
+    # Find the first row of each frame
+    newFrame     = np.ones(rowCount, dtype=bool)
+    newFrame[1:] = frames[1:] != frames[:-1]
+    runStart     = np.flatnonzero(newFrame)
+    runLength    = np.diff( np.append(runStart, rowCount) )
+    
+    counter = np.arange(rowCount, dtype=np.int64) - np.repeat(runStart, runLength)
+    
+    # Assemble the levels and codes directly instead of letting pandas
+    # factorize the (large) frame and counter arrays again.
+    if rowCount == 0 or np.all(frames[runStart[1:]] > frames[runStart[:-1]]):
+        frameLevel = frames[runStart]
+        frameCodes = np.repeat(np.arange(len(runStart), dtype=np.int64), runLength)
+    else: # frames are not sorted, fall back to the slower unique search
+        frameLevel, frameCodes = np.unique(frames, return_inverse=True)
+    counterLevel = np.arange(np.max(runLength) if rowCount > 0 else 0, dtype=np.int64)
+    
+    return MultiIndex([frameLevel, counterLevel], [frameCodes, counter], verify_integrity=False)
+
+
+def _countLines(f):
+    """ Number of lines from the current position to the end of the file """
+    lines = 0
+    last  = '\n'
+    for block in iter(lambda: f.read(2**24), ''):
+        lines += block.count('\n')
+        last   = block[-1]
+    return lines + (last != '\n') # the last line might not end with a newline
+
+
+def _readRapidStormHeader(header):
+    """ Parse the xml like header line of a rapidStorm file.
+    
+        Returns a dict mapping the column names used in SRVis to the column
+        index in the file. Columns that are not present are set to None.
+    """
+    # Rapidstorm creates variable output columns but stores the column
+    # type information in an xml like header file.
+    identifiers = { 'Position-0-0'             : 'x',
+                    'Position-0-0-uncertainty' : 'Uncertainty x',
+                    'Position-1-0'             : 'y',
+                    'Position-1-0-uncertainty' : 'Uncertainty y',
+                    'Amplitude-0-0'            : 'Photon Count',
+                    'ImageNumber-0-0'          : 'frame',
+                    'PSFWidth-0-0'             : 'PSF width x',
+                    'PSFWidth-1-0'             : 'PSF width y',
+                    'FitResidues-0-0'          : 'FitResidue',
+                    'LocalBackground-0-0'      : 'Local background' }
+    
+    columnIndex = dict( (name, None) for name in identifiers.values() )
+    
+    # Use the ElementTree xml parser to read the header
+    root = ET.fromstring(header[2:])
+    for index, child in enumerate(root):
+        name = identifiers.get(child.attrib['identifier'])
+        if name is not None:
+            columnIndex[name] = index
+    
+    # Make sure all necessary fields have been identified
+    assert( columnIndex['x']            != None )
+    assert( columnIndex['y']            != None )
+    assert( columnIndex['Photon Count'] != None )
+    assert( columnIndex['frame']        != None )
+    
+    return columnIndex
+
+
+def readRapidStormLocalisations(fname, photonConversion=1.0, pixelSize=1.0, chunkSize=1000000):
     """ Read rapidStorm localisations from text file.
     
         photonConversion should be set to convert the photon counts correctly
@@ -55,115 +115,78 @@ def readRapidStormLocalisations(fname, photonConversion=1.0, pixelSize=1.0):
             y    = y position
             sy   = error of y position
             amp  = amplitude
-    
+        
+        The file is streamed in blocks of chunkSize rows using the pandas C
+        parser. Only the used columns are kept and the unit conversion and
+        the SNR are computed per block, which is written into one array
+        allocated for the number of lines in the file. Apart from this array
+        the peak memory is bounded by the block size.
     """
     assert( isinstance(pixelSize, float) or isinstance(pixelSize, int) ) # int for backwards compatibility
     
     photonConversion = float(photonConversion)
     
-    idx       = indexGenerator()
     pixelSize = float(pixelSize)
     
-    xPosition            = None
-    xPositionUncertainty = None
-    yPosition            = None
-    yPositionUncertainty = None
-    amplitude            = None
-    imageNumber          = None
-    PSFpositionX         = None
-    PSFpositionY         = None
-    fitResidues          = None
+    # These are column names of the DataFrame by which the data can
+    # be accessed later.
+    columns = ['x','y','Uncertainty x','Uncertainty y','Photon Count', 'frame', \
+               'FitResidue', 'SNR']
     
     with open(fname, 'r') as f:
-        # Check the file structure. Rapidstorm creates variable output columns
-        # but stores the column type information in an xml like header file.
-        header = f.readline()
-        # Use the ElementTree xml parser to read the header
-        root = ET.fromstring(header[2:])
-        for index, child in enumerate(root):
-            if child.attrib['identifier']   == 'Position-0-0':
-                xPosition = index
-            elif child.attrib['identifier'] == 'Position-0-0-uncertainty':
-                xPositionUncertainty = index
-            elif child.attrib['identifier'] == 'Position-1-0':
-                yPosition = index
-            elif child.attrib['identifier'] == 'Position-1-0-uncertainty':
-                yPositionUncertainty = index
-            elif child.attrib['identifier'] == 'Amplitude-0-0':
-                amplitude  = index
-            elif child.attrib['identifier'] == 'ImageNumber-0-0':
-                imageNumber = index
-            elif child.attrib['identifier'] == 'PSFWidth-0-0':
-                PSFpositionX = index
-            elif child.attrib['identifier'] == 'PSFWidth-1-0':
-                PSFpositionY = index
-            elif child.attrib['identifier'] == 'FitResidues-0-0':
-                fitResidues = index
-            elif child.attrib['identifier'] == 'LocalBackground-0-0':
-                localBackground = index
-            
-        # Make sure all necessary fields have been identified
-        assert( xPosition            != None )
-        assert( yPosition            != None )
-        assert( amplitude            != None )
-        assert( imageNumber          != None )
+        # The number of lines bounds the number of rows, the array is filled
+        # in place and trimmed at the end
+        allData = np.empty((max(_countLines(f) - 1, 0), len(columns)), dtype=np.float64)
+        rowCount = 0
+        f.seek(0)
         
-    ## Read the full file
-    allData  = np.loadtxt(fname, skiprows=1) # this is the whole data
-    rowCount = np.shape(allData)[0]
-    
-    # Calculate the SNR
-    SNR      = np.zeros((rowCount,1))
-    SNR[:,0] = allData[:,amplitude] / allData[:,localBackground]
-    allData  = np.concatenate((allData,SNR),axis=1)
-    SNRindex = np.shape(allData)[1] - 1
-    
-    # Add a NaN column (used if a rapidstorm input column is missing)
-    zeros   = np.zeros((rowCount,1))
-    zeros.fill(np.NaN)
-    allData = np.concatenate((allData,zeros),axis=1)
-
-    # Convert the amplitude to photon count
-    allData[:,amplitude] /= photonConversion
-    
-    # Convert the x and y coordinates to pixels
-    allData[:,[xPosition,yPosition]] /= pixelSize
-
-    
-    # Check which data is there and what needs to be added
-    if xPositionUncertainty == None:
-        xPositionUncertainty = -1 # select the last column of all zeros
-        yPositionUncertainty = -1
-    if PSFpositionX == None:
-            PSFpositionX = -1
-            PSFpositionY = -1
-    if fitResidues == None:
-        fitResidues = -1
+        # Parse the header only once and continue reading the body from the
+        # same file handle.
+        header      = f.readline()
+        columnIndex = _readRapidStormHeader(header)
         
-    dataIndexes = [xPosition, yPosition, xPositionUncertainty, yPositionUncertainty, \
-                   amplitude, imageNumber, fitResidues, SNRindex]
-
+        # Only read the columns that are needed
+        fileColumns = [ columnIndex[name] for name in columns[:-1] + ['Local background'] ]
+        fileColumns = sorted( set( index for index in fileColumns if index is not None ) )
+        reader = read_csv(f, sep=r'\s+', header=None, usecols=fileColumns, \
+                          dtype=np.float64, engine='c', chunksize=chunkSize)
+        
+        for chunk in reader:
+            block = allData[rowCount:rowCount+len(chunk)]
+            block.fill(np.NaN) # used if a rapidstorm input column is missing
+            
+            for column, name in enumerate(columns[:-1]):
+                if columnIndex[name] is not None:
+                    block[:,column] = chunk[columnIndex[name]].values
+            
+            # Calculate the SNR
+            if columnIndex['Local background'] is not None:
+                block[:,-1] = block[:,4] / chunk[columnIndex['Local background']].values
+            
+            # Convert the amplitude to photon count
+            block[:,4] /= photonConversion
+            
+            # Convert the x and y coordinates to pixels
+            block[:,:2] /= pixelSize
+            
+            rowCount += len(chunk)
+            del chunk
+    
+    allData = allData[:rowCount] # e.g. without empty lines at the end
     
     # Assemble the index structure for the DataFrame
     # A two level index is used, i.e.
-    # frame_0   0
-    #           1
-    #           2
-    #           ...
-    # frame_1   0
-    #           1
-    #           etc.
-    level1 = [ 'frame_' + str(int(frame)) for frame in allData[:,imageNumber] ]
-    level2 = [ idx(frame) for frame in allData[:,imageNumber] ]
-    index  = [ level1, level2 ]
-    
-    # These are column names of the DataFrame by which the data can
-    # be accessed later.
-    columns = ['x','y','Uncertainty x','Uncertainty y','Photon Count', 'frame', \
-               'FitResidue', 'SNR']
+    # 0   0
+    #     1
+    #     2
+    #     ...
+    # 1   0
+    #     1
+    #     etc.
+    index = frameIndex(allData[:,5])
     
     # Create the DataFrame
-    data = DataFrame(allData[:,dataIndexes], columns=columns, index=index)
+    data = DataFrame(allData, columns=columns, index=index)
     
     # Drop columns that are nan
     data.dropna(axis=1, how='all', inplace=True)
@@ -194,15 +217,12 @@ def readXYTLocalisations(fname, pixelSize=1.0):
     allData  = np.loadtxt(fname, skiprows=1)
     
     # Sort ascending frames, thanks to: http://stackoverflow.com/a/2828121
-    frameIndex = header.index('frame')
-    allData = allData[allData[:,frameIndex].argsort()]
+    frameIndexColumn = header.index('frame')
+    allData = allData[allData[:,frameIndexColumn].argsort(kind='mergesort')]
     
     # Assemble the index structure for the DataFrame
     # See readRapidStormLocalisations comments for a brief explanation.
-    idx         = indexGenerator()
-    level1 = [ 'frame_' + str(int(frame)) for frame in allData[:,frameIndex] ]
-    level2 = [ idx(frame) for frame in allData[:,frameIndex] ]
-    index  = [ level1, level2 ]
+    index = frameIndex(allData[:,frameIndexColumn])
     
     # Put the data together
     data = DataFrame(allData, index=index, columns=header)
@@ -213,15 +233,95 @@ def readXYTLocalisations(fname, pixelSize=1.0):
     return data
 
 
+def _cacheFileNames(fname):
+    """ The binary cache is stored next to the localisation file """
+    return fname + '.srvis.npy', fname + '.srvis.json'
 
 
+def _cacheKey(fname, reader, **settings):
+    """ Describes the source file and the settings used to parse it """
+    stat = os.stat(fname)
+    key  = { 'source' : os.path.abspath(fname),
+             'mtime'  : stat.st_mtime,
+             'size'   : stat.st_size,
+             'reader' : reader.__name__ }
+    for name in settings:
+        key[name] = float(settings[name])
+    return key
 
 
+def readCache(fname, key):
+    """
+    Open the binary cache of fname as memory-mapped DataFrame. Returns None
+    if there is no cache or if it was created for a different key, i.e. the
+    source file or the reading settings changed.
+    
+    The cache is opened copy-on-write, so pages are only read from disk when
+    they are accessed and modifications never reach the cache file.
+    """
+    fnameData, fnameMeta = _cacheFileNames(fname)
+    try:
+        with open(fnameMeta, 'r') as f:
+            meta = json.load(f)
+        if meta['key'] != key:
+            return None
+        allData = np.load(fnameData, mmap_mode='c')
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    
+    index = frameIndex(allData[:,meta['frameColumn']])
+    return DataFrame(allData, columns=meta['columns'], index=index, copy=False)
 
 
+def writeCache(fname, key, data):
+    """
+    Store the values of the DataFrame data column by column as .npy file
+    next to fname. The metadata is written last so that an interrupted
+    write leaves an invalid cache behind rather than a corrupt one.
+    
+    The data is written to a temporary file that then replaces the cache.
+    An old cache file that is still memory-mapped by the shown data is
+    therefore never truncated.
+    """
+    fnameData, fnameMeta = _cacheFileNames(fname)
+    meta = { 'key'         : key,
+             'columns'     : list(data.columns),
+             'frameColumn' : list(data.columns).index('frame') }
+    fnameTemp = None
+    try:
+        handle, fnameTemp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(fnameData)))
+        # Fortran order keeps each column contiguous on disk, which is also
+        # the memory layout pandas uses for its blocks.
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, np.asfortranarray(data.values, dtype=np.float64))
+        
+        if os.path.exists(fnameMeta):
+            os.remove(fnameMeta)
+        if os.name == 'nt' and os.path.exists(fnameData): # rename does not replace files on Windows
+            os.remove(fnameData)
+        os.rename(fnameTemp, fnameData)
+        with open(fnameMeta, 'w') as f:
+            json.dump(meta, f)
+    except Exception: # the cache is optional, the data was read anyway
+        print 'Could not write the localisation cache for ' + fname
+    finally:
+        try:
+            if fnameTemp is not None and os.path.exists(fnameTemp):
+                os.remove(fnameTemp)
+        except OSError:
+            pass
 
 
-
-
-
-
+def readCachedLocalisations(reader, fname, **settings):
+    """
+    Read the localisations in fname with reader, e.g. readRapidStormLocalisations,
+    and the keyword arguments in settings. The parsed data is cached in a
+    binary file that is used instead of the text file as long as the file
+    and the settings are unchanged.
+    """
+    key  = _cacheKey(fname, reader, **settings)
+    data = readCache(fname, key)
+    if data is None:
+        data = reader(fname, **settings)
+        writeCache(fname, key, data)
+    return data
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SRVis  Copyright (C) 2015  Niklas Berliner
+"""
+import numpy as np
+from pandas import DataFrame
+from scipy.spatial import cKDTree
+
+
+def pointsInPolygon(x, y, vertices):
+    """
+    Boolean mask of the points (x, y) inside the polygon given by its (N,2)
+    vertices (even-odd rule). The polygon is closed automatically.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    vertices = np.asarray(vertices, dtype=np.float64)
+    inside   = np.zeros(len(x), dtype=bool)
+    
+    # Count the crossings of a ray in +x direction with each edge. Only the
+    # points within the y range of an edge are tested against it.
+    xj, yj = vertices[-1]
+    for xi, yi in vertices:
+        crossing = np.flatnonzero( (yi > y) != (yj > y) )
+        if len(crossing) > 0:
+            xCross = (xj - xi) * (y[crossing] - yi) / (yj - yi) + xi
+            inside[crossing] ^= x[crossing] < xCross
+        xj, yj = xi, yi
+    return inside
+
+
+def _isRectangle(vertices):
+    """ True if the vertices describe an axis aligned rectangle """
+    if len(vertices) != 4:
+        return False
+    xs = np.unique(vertices[:,0])
+    ys = np.unique(vertices[:,1])
+    if len(xs) != 2 or len(ys) != 2:
+        return False
+    # Each corner must be present once, i.e. consecutive vertices differ in one coordinate
+    edges = vertices - np.roll(vertices, 1, axis=0)
+    return np.all( (edges[:,0] == 0) != (edges[:,1] == 0) )
+
+
+class gridIndex(object):
+    """
+    Uniform grid over the localisations for fast range queries.
+    
+    The localisations are sorted by grid cell (row by row) and the start of
+    each cell in the sorted data is stored in an offset array. The cells of
+    one grid row that overlap a rectangle are therefore one contiguous block
+    of the sorted data and only the localisations in the border cells have
+    to be tested individually.
+    """
+    def __init__(self, data, pointsPerCell=32):
+        """
+        data:          localisations as (N,2) array of x and y positions
+        pointsPerCell: average number of localisations per occupied cell
+                       used to choose the cell size
+        """
+        if isinstance( data, DataFrame ):
+            data = np.array(data[['x','y']])
+        assert( np.shape(data)[1] == 2 ) # Data should be two-dimensional
+        
+        x = np.asarray(data[:,0], dtype=np.float64)
+        y = np.asarray(data[:,1], dtype=np.float64)
+        N = len(x)
+        
+        if N == 0:
+            self.mins = np.zeros(2)
+            self.maxs = np.ones(2)
+        else:
+            self.mins = np.array((np.min(x), np.min(y)))
+            self.maxs = np.array((np.max(x), np.max(y)))
+        
+        # Choose the cell size such that the cells hold on average
+        # pointsPerCell localisations for uniformly distributed data
+        area  = max(np.prod(self.maxs - self.mins), 1e-12)
+        cells = max(N / float(pointsPerCell), 1.0)
+        self.cellSize = max(np.sqrt(area / cells), 1e-6)
+        self.nrCells  = ( (self.maxs - self.mins) // self.cellSize ).astype(np.int64) + 1
+        
+        cellX = ((x - self.mins[0]) // self.cellSize).astype(np.int64)
+        cellY = ((y - self.mins[1]) // self.cellSize).astype(np.int64)
+        cell  = cellY * self.nrCells[0] + cellX
+        
+        self.order   = np.argsort(cell, kind='mergesort') # sorted position -> original index
+        self.x       = x[self.order]
+        self.y       = y[self.order]
+        self.offsets = np.zeros(np.prod(self.nrCells) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(cell, minlength=np.prod(self.nrCells)))
+    
+    def __len__(self):
+        return len(self.order)
+    
+    def _cellRange(self, value, axis):
+        cell = int(np.floor((value - self.mins[axis]) / self.cellSize))
+        return min(max(cell, 0), self.nrCells[axis] - 1)
+    
+    def _rectangleCandidates(self, xmin, xmax, ymin, ymax):
+        """ Sorted positions of all localisations in the cells overlapping the rectangle """
+        if xmax < self.mins[0] or xmin > self.maxs[0] or ymax < self.mins[1] or ymin > self.maxs[1]:
+            return np.zeros(0, dtype=np.int64)
+        
+        cx0, cx1 = self._cellRange(xmin, 0), self._cellRange(xmax, 0)
+        cy0, cy1 = self._cellRange(ymin, 1), self._cellRange(ymax, 1)
+        
+        # One contiguous block of the sorted data per grid row
+        rows   = np.arange(cy0, cy1+1) * self.nrCells[0]
+        starts = self.offsets[rows + cx0]
+        stops  = self.offsets[rows + cx1 + 1]
+        
+        lengths = stops - starts
+        total   = np.sum(lengths)
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Concatenate the ranges start:stop without a Python loop over the rows
+        shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.arange(total, dtype=np.int64) + shift
+    
+    def queryRectangleSorted(self, xmin, xmax, ymin, ymax):
+        """ Positions in the sorted data (self.x, self.y) of the localisations
+        inside the rectangle (boundaries included) """
+        candidates = self._rectangleCandidates(xmin, xmax, ymin, ymax)
+        x = self.x[candidates]
+        y = self.y[candidates]
+        inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        return candidates[inside]
+    
+    def queryRectangle(self, xmin, xmax, ymin, ymax):
+        """ Indices (into the original data) of the localisations inside the
+        rectangle (boundaries included) """
+        return self.order[self.queryRectangleSorted(xmin, xmax, ymin, ymax)]
+    
+    def queryPolygon(self, vertices):
+        """
+        Indices (into the original data) of the localisations inside the
+        polygon given by its (N,2) vertices, sorted ascending. Only the
+        localisations in the grid cells overlapping the bounding box of the
+        polygon are tested individually.
+        """
+        vertices = np.asarray(vertices, dtype=np.float64)
+        assert( vertices.ndim == 2 and vertices.shape[1] == 2 and len(vertices) >= 3 )
+        
+        xmin, ymin = np.min(vertices, axis=0)
+        xmax, ymax = np.max(vertices, axis=0)
+        inside = self.queryRectangleSorted(xmin, xmax, ymin, ymax)
+        if not _isRectangle(vertices): # the bounding box is only a prefilter
+            inside = inside[pointsInPolygon(self.x[inside], self.y[inside], vertices)]
+        return np.sort(self.order[inside])
+    
+    def pointsInRectangle(self, xmin, xmax, ymin, ymax):
+        """ x and y positions of the localisations inside the rectangle """
+        inside = self.queryRectangleSorted(xmin, xmax, ymin, ymax)
+        return self.x[inside], self.y[inside]
+
+
+class localisationIndex(gridIndex):
+    """
+    Spatial index over the localisations of one data variant. Rectangle
+    queries use the uniform grid, neighbour and radius queries a KD-tree
+    that is only built on first use.
+    
+    All queries return row indices into the data the index was built from.
+    """
+    def __init__(self, data, pointsPerCell=32):
+        gridIndex.__init__(self, data, pointsPerCell=pointsPerCell)
+        self._kdTree = None
+    
+    @property
+    def kdTree(self):
+        """ cKDTree over the grid sorted positions, built on first access """
+        if self._kdTree is None:
+            self._kdTree = cKDTree(np.column_stack((self.x, self.y)))
+        return self._kdTree
+    
+    def queryRadius(self, x, y, r):
+        """ Indices of the localisations within distance r of (x, y) """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        inside = np.asarray(self.kdTree.query_ball_point((x, y), r), dtype=np.int64)
+        return np.sort(self.order[inside])
+    
+    def queryNeighbours(self, points, k=1, distanceUpperBound=np.inf):
+        """
+        The k nearest localisations of each point in points ((M,2) array).
+        Returns the distances and indices as for cKDTree.query, missing
+        neighbours have distance inf and index len(self).
+        """
+        distances, inside = self.kdTree.query(points, k=k, distance_upper_bound=distanceUpperBound)
+        found   = inside < len(self)
+        indices = np.empty_like(inside)
+        indices.fill(len(self))
+        indices[found] = self.order[inside[found]]
+        return distances, indices
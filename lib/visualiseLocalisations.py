@@ -16,14 +16,216 @@
 """
 SRVis  Copyright (C) 2015  Niklas Berliner
 """
+import time
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.filters import gaussian_filter1d
+from scipy.ndimage.fourier import fourier_gaussian
+from scipy.fftpack import next_fast_len
 from matplotlib import pyplot as plt
+from matplotlib.collections import PolyCollection
 from pandas import DataFrame
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 
+def _spreadBits(v):
+    """ Insert a zero bit between each of the lower 31 bits of v """
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8))  & 0x00FF00FF00FF00FF
+    v = (v | (v << 4))  & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2))  & 0x3333333333333333
+    v = (v | (v << 1))  & 0x5555555555555555
+    return v
+
+def mortonCode(x, y):
+    """
+    Z-order (Morton) code of the non-negative integer coordinates x and y
+    (each below 2**31). Cells that form an aligned 2**L x 2**L block have
+    consecutive codes, starting at mortonCode(x >> L, y >> L) << 2*L.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    return _spreadBits(x) | (_spreadBits(y) << 1)
+
+def _binIndex(a, edges):
+    """
+    Bin index of the values a for the uniform bin edges. The points outside
+    of the edges are set to -1. Values on an edge are assigned exactly like
+    np.histogram2d does, i.e. the last bin includes its right edge.
+    """
+    nrBins = len(edges) - 1
+    first, last = edges[0], edges[-1]
+    
+    index = (a - first) * (nrBins / (last - first))
+    index = index.astype(np.intp)
+    np.clip(index, 0, nrBins - 1, out=index)
+    # Correct for rounding errors close to the edges
+    index -= a < edges[index]
+    index += (a >= edges[index + 1]) & (index != nrBins - 1)
+    index[(a < first) | (a > last)] = -1
+    return index
+
+def _histogramChunk(x, y, xedges, yedges):
+    """ Partial histogram of one chunk of points, flattened in C order """
+    nrY = len(yedges) - 1
+    ix = _binIndex(x, xedges)
+    iy = _binIndex(y, yedges)
+    inside = (ix >= 0) & (iy >= 0)
+    if not inside.all():
+        ix, iy = ix[inside], iy[inside]
+    return np.bincount(ix * nrY + iy, minlength=(len(xedges) - 1) * nrY)
+
+def uniformEdges(x, y, bins, range=None):
+    """ The bin edges used by np.histogram2d(x, y, bins, range) """
+    nx, ny = int(bins[0]), int(bins[1])
+    if range is None:
+        if len(x) == 0:
+            range = [[0.0, 1.0], [0.0, 1.0]]
+        else:
+            range = [[np.min(x), np.max(x)], [np.min(y), np.max(y)]]
+    
+    edges = list()
+    for (low, high), nrBins in zip(range, (nx, ny)):
+        if low == high: # same as numpy, use a unit range
+            low, high = low - 0.5, high + 0.5
+        edges.append(np.linspace(low, high, nrBins + 1))
+    return edges
+
+def histogramUniform(x, y, bins, range=None, chunkSize=2**22, threads=None):
+    """
+    Two dimensional histogram with uniform bins.
+    
+    Drop-in replacement for np.histogram2d(x, y, bins, range) for integer
+    bin numbers (nx, ny). The bin index is computed directly from the
+    position and the counts are accumulated with np.bincount, which avoids
+    the binary search over the edges. Large inputs are processed in chunks
+    on a thread pool, each thread adds its chunks to its own histogram.
+    
+    Returns H, xedges, yedges with x along the first dimension of H.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    nx, ny = int(bins[0]), int(bins[1])
+    xedges, yedges = uniformEdges(x, y, bins, range)
+    
+    chunks = [ (start, start + chunkSize) for start in np.arange(0, len(x), chunkSize) ]
+    if threads is None:
+        threads = cpu_count()
+    threads = max(min(threads, len(chunks)), 1)
+    
+    def histogramChunks(worker):
+        # Every threads-th chunk, such that the memory is threads x bins
+        H = np.zeros(nx * ny, dtype=np.float64)
+        for start, stop in chunks[worker::threads]:
+            H += _histogramChunk(x[start:stop], y[start:stop], xedges, yedges)
+        return H
+    
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            partials = pool.map(histogramChunks, xrange(threads))
+        finally:
+            pool.close()
+        H = partials[0]
+        for partial in partials[1:]:
+            H += partial
+    else:
+        H = histogramChunks(0)
+    return H.reshape(nx, ny), xedges, yedges
+
+def _blurSeparable(H, sigma, truncate):
+    """ Two 1D passes of a truncated gaussian kernel, in place in float32 """
+    H = np.array(H, dtype=np.float32) # the input is not modified
+    for axis in (0, 1):
+        if sigma[axis] > 0:
+            gaussian_filter1d(H, sigma[axis], axis=axis, output=H, mode='reflect', truncate=truncate)
+    return H
+
+def _blurFFT(H, sigma, truncate):
+    """
+    Multiplication with the gaussian transfer function in Fourier space.
+    The histogram is padded by reflection (same boundary as 'reflect' in
+    scipy.ndimage) to avoid wrapping around the borders.
+    """
+    radius  = [ int(np.ceil(truncate * s)) for s in sigma ]
+    shape   = [ next_fast_len(n + 2 * r) for n, r in zip(np.shape(H), radius) ]
+    padding = [ (r, size - n - r) for n, r, size in zip(np.shape(H), radius, shape) ]
+    padded  = np.pad(np.asarray(H, dtype=np.float32), padding, mode='symmetric')
+    
+    F = np.fft.rfft2(padded)
+    F = fourier_gaussian(F, sigma, n=shape[1])
+    blurred = np.fft.irfft2(F, s=shape)
+    return np.array(blurred[radius[0]:radius[0]+np.shape(H)[0], radius[1]:radius[1]+np.shape(H)[1]], dtype=np.float32)
+
+# The available gaussian blur implementations
+blurBackends = OrderedDict([ ('separable', _blurSeparable),
+                             ('fft',       _blurFFT) ])
+
+def chooseBlurBackend(shape, sigma, truncate=3.0):
+    """
+    Select the cheaper gaussian blur implementation. The separable filter
+    costs about 2*(2*truncate*sigma+1) operations per bin, the FFT about
+    log2 of the number of bins (with a larger constant). For different
+    sigmas per axis the mean is used.
+    """
+    nrBins = max(np.prod(shape), 2)
+    taps   = 2 * (2 * truncate * np.mean(sigma) + 1)
+    if taps > 5 * np.log2(nrBins):
+        return 'fft'
+    return 'separable'
+
+def gaussianBlur(H, sigma, backend='auto', truncate=3.0):
+    """
+    Gaussian blur of the 2D histogram H with 'reflect' boundaries. The
+    kernel is truncated at truncate*sigma and the result is float32.
+    
+    sigma:   a scalar or one sigma per axis of H (in bins)
+    backend: 'separable', 'fft' or 'auto' to choose based on the image size
+             and sigma (see chooseBlurBackend)
+    
+    Returns the blurred histogram and the name of the backend used.
+    """
+    if backend == 'auto':
+        backend = chooseBlurBackend(np.shape(H), sigma, truncate)
+    sigma = np.maximum(np.broadcast_to(np.asarray(sigma, dtype=np.float64), (2, )), 0.0)
+    if np.all(sigma == 0):
+        return np.array(H, dtype=np.float32), backend
+    return blurBackends[backend](H, tuple(sigma), truncate), backend
+
+def _sigmaLevel(sigma, step, minSigma):
+    """
+    Logarithmic quantisation of sigma with a relative step. Values below
+    minSigma (or NaN) are not blurred and get the level -2**30.
+    """
+    level = np.full(np.shape(sigma), -2**30, dtype=np.int64)
+    with np.errstate(invalid='ignore'):
+        valid = sigma >= minSigma # False for NaN
+    level[valid] = np.round( np.log(sigma[valid]) / np.log1p(step) ).astype(np.int64)
+    return level
+
+def _levelSigma(level, step):
+    """ The sigma represented by a quantisation level of _sigmaLevel() """
+    return 0.0 if level == -2**30 else (1.0 + step)**level
+
+def _gaussianKernel1d(sigma, truncate):
+    """ Normalised sampled gaussian, same as used by gaussian_filter1d """
+    if sigma <= 0:
+        return np.ones(1)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * x**2 / sigma**2)
+    return kernel / kernel.sum()
+
+def _reflectIndex(index, n):
+    """ Map indices outside of [0, n) back like the 'reflect' boundary mode,
+    which is periodic with 2n, i.e. also for kernels longer than n """
+    index = np.mod(index, 2 * n)
+    return np.where(index >= n, 2 * n - index - 1, index)
+
 class Color:
     """
     Helper to assign colors to float or integer values mapped to a given range.
@@ -42,14 +244,16 @@ class Color:
 
     def __call__(self, N):
         
+        # N can be a single value or an array of values
+        N = np.asarray(N, dtype=np.float64)
         if self.scaleMin == None and self.scaleMax != None:
-            c = float(N) / self.scaleMax
+            c = N / self.scaleMax
         elif self.scaleMin != None and self.scaleMax == None:
-            c = float(N)  - self.scaleMin
+            c = N  - self.scaleMin
         elif self.scaleMin == None and self.scaleMax == None:
-            c = float(N)
+            c = N
         else:
-            c = (float(N) - self.scaleMin) / ( self.scaleMax - self.scaleMin )
+            c = (N - self.scaleMin) / ( self.scaleMax - self.scaleMin )
   
         return self.cmap(c)
     
@@ -92,82 +296,196 @@ class QuadTree(object):
         self.unitArea = np.power(unitLength,2)
         self.color    = None
         
-        self.patches        = [(data, [self.mins, self.maxs]), ]
-        self.patchCriterion = [False, ]
+        # The leaves of the tree, see _run()
+        self.leafMins   = None # lower left corner of each leaf, shape (n,2)
+        self.leafMaxs   = None # upper right corner of each leaf, shape (n,2)
+        self.counts     = None # number of localisations in each leaf
+        self.leafLevels = None # depth of each leaf in the tree
+        self.leafRanges = None # (start, stop) of the leaf points in self.order
+        self.leafCodes  = None # first Z-order code (at self.depth) of each leaf
+        
+        # The points sorted by their Z-order code at a fixed fine level.
+        # This does not depend on eps and unitLength, such that the leaves
+        # can be derived again cheaply, see setParameters().
+        self.depth = 20 # level of the Z-order codes
+        size  = np.where(self.maxs > self.mins, self.maxs - self.mins, 1.0)
+        cells = np.floor((self.data - self.mins) / size * 2**self.depth).astype(np.int64)
+        np.clip(cells, 0, 2**self.depth - 1, out=cells)
+        codes = mortonCode(cells[:,0], cells[:,1])
+        self.order = np.argsort(codes, kind='mergesort') # data[order] is sorted by the Z-order
+        self.codes = codes[self.order]
         
         self._run()
     
-    def _checkPatch(self, patch):
+    def setParameters(self, eps=None, unitLength=None):
+        """ Change the split criteria, the points are not sorted again """
+        if eps is not None:
+            self.eps = eps
+        if unitLength is not None:
+            self.unitArea = np.power(unitLength,2)
+        self._run()
+    
+    def _maxLevel(self):
         """
-        Divide a patch if it does not meet the given criteria
+        The deepest level at which a patch can still be divided, i.e. the
+        area of its children is not below unitArea.
         """
-        data, (mins, maxs) = patch
-        area = (maxs[0] - mins[0]) * (maxs[1] - mins[1])
-        # Don't divide the patch further if
-        # (1) number of localisations is below threshold
-        # (2) the area of the patch is below theshold
-        if len(data) < self.eps or area < self.unitArea:
-            return [True, ], [(data, (mins, maxs)) ]
-        
-        # The old patch boundaries
-        xmid, ymid = 0.5 * (mins + maxs)
-        xmin, ymin = mins
-        xmax, ymax = maxs
-        
-        # Set the new boundaries of the divided patch
-        q1 = (np.asarray([xmin, ymin]), np.asarray([xmid, ymid]))
-        q2 = (np.asarray([xmin, ymid]), np.asarray([xmid, ymax]))
-        q3 = (np.asarray([xmid, ymin]), np.asarray([xmax, ymid]))
-        q4 = (np.asarray([xmid, ymid]), np.asarray([xmax, ymax]))
-
-        # Divide the patch into quadrants
-        data_q1 = data[(data[:,0] <  xmid) & (data[:,1] <  ymid)]
-        data_q2 = data[(data[:,0] <  xmid) & (data[:,1] >= ymid)]
-        data_q3 = data[(data[:,0] >= xmid) & (data[:,1] <  ymid)]
-        data_q4 = data[(data[:,0] >= xmid) & (data[:,1] >= ymid)]
-        
-        return [False, False, False, False], [(data_q1, q1), (data_q2, q2), (data_q3, q3), (data_q4, q4)]
-    
+        area = np.prod(self.maxs - self.mins)
+        if area <= 0:
+            return 0
+        if self.unitArea <= 0:
+            return self.depth
+        # area / 4**level >= unitArea
+        return int(np.clip(np.floor(np.log(area / self.unitArea) / np.log(4)) + 1, 0, self.depth))
     
     def _run(self):
         """
-        Iteratively divide all patches until all satisfy the stop criterion
-        and are not divided further.
+        Build the tree from the points sorted by their Z-order code.
+        
+        The points of every patch at level L form a contiguous range of the
+        sorted codes, and the four children of a patch divide this range.
+        The tree is therefore built level by level by splitting index
+        ranges with np.searchsorted, without copying any point data.
         """
-        i = 0
-        while not np.all(self.patchCriterion):
-            # Sanity stop criterion to prevent dead end if something goes wrong
-            if i == 1000000:
-                print 'Maximun iterations step reached'
-                break
-            i += 1
+        maxLevel = self._maxLevel()
+        codes = self.codes
+        
+        # The patches of the current level: cell coordinates and point ranges
+        ix, iy = np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        start  = np.zeros(1, dtype=np.int64)
+        stop   = np.array([len(codes)], dtype=np.int64)
+        
+        leaves = list()
+        for level in xrange(maxLevel + 1):
+            # Don't divide the patch further if
+            # (1) number of localisations is below threshold
+            # (2) the area of the patch is below theshold
+            area   = np.prod(self.maxs - self.mins) / 4.0**level
+            divide = (stop - start >= self.eps) & (area >= self.unitArea) & (level < maxLevel)
             
-            # Take the first element of the list and check it
-            patch = self.patches.pop(0)
-            if self.patchCriterion.pop(0) == False: # Remove the flag
-                # The patch needs to be checked
-                newCriterion, newPatches = self._checkPatch(patch)
-            else:
-                # The patch is already small enough
-                newCriterion, newPatches = [True, ], [patch, ]
+            leaf = ~divide
+            leaves.append( (level, ix[leaf], iy[leaf], start[leaf], stop[leaf]) )
+            if not np.any(divide):
+                break
             
-            # Add the new patches back to the list
-            self.patchCriterion.extend(newCriterion)
-            self.patches.extend(newPatches)
+            # The four children, in Z-order, of each patch that is divided
+            ix, iy = ix[divide], iy[divide]
+            start, stop = start[divide], stop[divide]
+            childX = (2 * ix[:,None] + np.array([0, 1, 0, 1])).ravel()
+            childY = (2 * iy[:,None] + np.array([0, 0, 1, 1])).ravel()
+            shift  = 2 * (self.depth - level - 1)
+            bounds = np.searchsorted(codes, mortonCode(childX, childY) << shift).reshape(-1, 4)
+            bounds[:,0] = start # the children fill the parent range
+            ix, iy = childX, childY
+            start  = bounds.ravel()
+            stop   = np.column_stack((bounds[:,1:], stop)).ravel()
+        
+        # Collect the leaves of all levels into arrays
+        levels = np.concatenate([ np.full(len(x), level, dtype=np.int64) for level, x, _, _, _ in leaves ])
+        cellX  = np.concatenate([ x for _, x, _, _, _ in leaves ])
+        cellY  = np.concatenate([ y for _, _, y, _, _ in leaves ])
+        cellSize = (self.maxs - self.mins)[None,:] / (2.0**levels)[:,None]
         
-        # Now every patch satisfies the criterion and we're done.
+        self.leafLevels = levels
+        self.leafCodes  = mortonCode(cellX, cellY) << (2 * (self.depth - levels))
+        self.leafMins   = self.mins + np.column_stack((cellX, cellY)) * cellSize
+        self.leafMaxs   = self.leafMins + cellSize
+        self.leafRanges = np.column_stack(( np.concatenate([ b for _, _, _, b, _ in leaves ]),
+                                            np.concatenate([ e for _, _, _, _, e in leaves ]) ))
+        self.counts     = self.leafRanges[:,1] - self.leafRanges[:,0]
         return
+    
+    def __len__(self):
+        """ Number of leaves """
+        return len(self.counts)
+    
+    def leafPoints(self, leaf):
+        """ The localisations that fall into the given leaf """
+        start, stop = self.leafRanges[leaf]
+        return self.data[self.order[start:stop]]
+    
+    def density(self):
+        """ Number of localisations per area of each leaf """
+        area = np.prod(self.leafMaxs - self.leafMins, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(area > 0, self.counts / area, 0.0)
+    
+    def collection(self, **kwargs):
+        """
+        All leaves as a single PolyCollection colored by their density.
+        setColorBar() has to be called before.
+        """
+        x0, y0 = self.leafMins[:,0], self.leafMins[:,1]
+        x1, y1 = self.leafMaxs[:,0], self.leafMaxs[:,1]
+        verts  = np.stack(( np.column_stack((x0, x1, x1, x0)),
+                            np.column_stack((y0, y0, y1, y1)) ), axis=-1)
+        kwargs.setdefault('edgecolors', 'none')
+        kwargs.setdefault('zorder', 2)
+        return PolyCollection(verts, facecolors=self.color(self.density()), **kwargs)
+    
+    def rasterise(self, pixelSize, xlim=None, ylim=None):
+        """
+        Rasterise the leaf densities into an image of square pixels of size
+        pixelSize (in units of the data). The region defaults to the
+        boundaries of the tree.
+        
+        Each pixel takes the density of the leaf at its center. Where the
+        leaves are smaller than the pixels, the number of localisations per
+        pixel area is used instead, i.e. the average of the leaf densities.
+        
+        Returns the image with the rows along y and its extent
+        [xmin, xmax, ymax, ymin] (for imshow with origin='upper').
+        """
+        xmin, xmax = sorted(xlim) if xlim is not None else (self.mins[0], self.maxs[0])
+        ymin, ymax = sorted(ylim) if ylim is not None else (self.mins[1], self.maxs[1])
+        nx = max(int(np.ceil((xmax - xmin) / pixelSize)), 1)
+        ny = max(int(np.ceil((ymax - ymin) / pixelSize)), 1)
+        xmax = xmin + nx * pixelSize
+        ymax = ymin + ny * pixelSize
+        
+        # The leaves partition the Z-order codes at self.depth, the leaf
+        # holding a position is found by a binary search over the first
+        # code of each leaf.
+        leafOrder = np.argsort(self.leafCodes)
+        first     = self.leafCodes[leafOrder]
+        
+        x = xmin + (np.arange(nx) + 0.5) * pixelSize
+        y = ymin + (np.arange(ny) + 0.5) * pixelSize
+        size  = np.where(self.maxs > self.mins, self.maxs - self.mins, 1.0)
+        cellX = np.floor((x - self.mins[0]) / size[0] * 2**self.depth).astype(np.int64)
+        cellY = np.floor((y - self.mins[1]) / size[1] * 2**self.depth).astype(np.int64)
+        insideX = (x >= self.mins[0]) & (x <= self.maxs[0])
+        insideY = (y >= self.mins[1]) & (y <= self.maxs[1])
+        codes = mortonCode(np.clip(cellX, 0, 2**self.depth - 1)[None,:], np.clip(cellY, 0, 2**self.depth - 1)[:,None])
+        leaf  = leafOrder[np.searchsorted(first, codes, side='right') - 1]
+        
+        image = self.density()[leaf]
+        image[~(insideY[:,None] & insideX[None,:])] = 0.0
+        
+        # Leaves smaller than a pixel: average over the pixel
+        leafArea = np.prod(self.leafMaxs - self.leafMins, axis=1)
+        small = leafArea[leaf] < pixelSize**2
+        if np.any(small):
+            # Only the points of the leaves overlapping the view, taken from
+            # their ranges in the Z-order
+            visible = np.all(self.leafMins <= (xmax, ymax), axis=1) & np.all(self.leafMaxs >= (xmin, ymin), axis=1)
+            if np.all(visible):
+                points = self.data
+            else:
+                start, stop = self.leafRanges[visible].T
+                length = stop - start
+                rows   = np.repeat(start - np.cumsum(length) + length, length) + np.arange(np.sum(length))
+                points = self.data[self.order[rows]]
+            counts, _, _ = histogramUniform(points[:,1], points[:,0], bins=(ny, nx), range=[[ymin, ymax], [xmin, xmax]])
+            image[small] = counts[small] / pixelSize**2
+        
+        return image, [xmin, xmax, ymax, ymin]
 
     def setColorBar(self, scaleMin=None, scaleMax=None):
         # The color intensity is scaled by (number of localisations) / (area of the patch)
     
         # Try to find an optimal auto scaling
-        scaleAuto = list()
-        for patch, (mins, maxs) in self.patches:
-            size = maxs - mins
-            area = (maxs[0] - mins[0]) * (maxs[1] - mins[1])
-            N    = float(len(patch)) / area # This is the "intensity" of the patch
-            scaleAuto.append(N)
+        scaleAuto = self.density() # This is the "intensity" of the patch
         
         # Set the auto-scale boundaries
         scaleMinAuto = np.percentile(scaleAuto, 5)  # Don't include too much background
@@ -189,9 +507,12 @@ class QuadTree(object):
         # Initialise the color class
         self.color = Color(scaleMin, scaleMax)
     
-    def plot(self, scaleMin=None, scaleMax=None, fname=None, show=True):
+    def plot(self, scaleMin=None, scaleMax=None, fname=None, show=True, pixelSize=None):
         """
         Generate the quadtree histogram
+        
+        pixelSize: if given the leaves are rasterised into an image with this
+                   pixel size instead of drawing one polygon per leaf
         """
         # Get the colorbar
         if scaleMin == None and scaleMax == None and self.color == None:
@@ -214,18 +535,17 @@ class QuadTree(object):
         cax = divider.append_axes("right", size="5%", pad=0.05)
         plt.colorbar(sm, cax=cax)
         
-        # Add all the patches to the figure
-        # This might not be the smartest way of doing it and it will
-        # be slow for large histograms with many bins!
-        rectangles = list()
-        for patch, (mins, maxs) in self.patches:
-            size = maxs - mins
-            area = (maxs[0] - mins[0]) * (maxs[1] - mins[1])
-            N    = float(len(patch)) / area
-            rect = plt.Rectangle(mins, *size, zorder=2,
-                                 ec='none', fc=self.color(N))
-            rectangles.append(rect)
-            ax.add_patch(rect)
+        # Add all the patches to the figure, either as one collection or as
+        # a rasterised image
+        if pixelSize is None:
+            artist = self.collection()
+            ax.add_collection(artist)
+        else:
+            image, extent = self.rasterise(pixelSize)
+            artist = ax.imshow(image, extent=extent, interpolation='nearest', origin='upper',
+                               cmap=self.color.cmap, zorder=2,
+                               norm=plt.Normalize(vmin=self.color.scaleMin, vmax=self.color.scaleMax))
+            ax.set_ylim(self.mins[1], self.maxs[1]) # imshow inverts the y axis
         
         # Save the image to disk and/or show it
         if fname != None:
@@ -233,31 +553,259 @@ class QuadTree(object):
         if show:
             plt.show()
         
-        return fig, ax, rectangles, sm
+        return fig, ax, artist, sm
     
 
+class HistogramPyramid(object):
+    """
+    Multi-resolution 2D histogram of localisations organised in square tiles.
+    
+    Level 0 uses bins of binSize, every further level doubles the bin size
+    until the whole data fits into a single tile. Tiles are only computed
+    when they are requested and the most recently used ones are cached, so
+    that rendering a view only costs the localisations inside the visible
+    tiles at the level that matches the screen resolution.
+    
+    The localisations are sorted once by the Morton code of their level 0
+    tile. The localisations of any tile, at any level, are then a
+    contiguous range of the sorted data.
+    """
+    def __init__(self, data, binSize=1, tileSize=256, maxTiles=256):
+        """
+        data:     localisations as (N,2) array of x and y positions
+        binSize:  edge length of the level 0 bins
+        tileSize: number of bins along the edge of one tile
+        maxTiles: maximum number of cached tiles
+        """
+        if isinstance( data, DataFrame ):
+            data = np.array(data[['x','y']])
+        assert( np.shape(data)[1] == 2 ) # Data should be two-dimensional
+        
+        self.binSize  = float(binSize)
+        self.tileSize = int(tileSize)
+        self.maxTiles = maxTiles
+        self.tiles    = OrderedDict()
+        
+        x = np.asarray(data[:,0], dtype=np.float64)
+        y = np.asarray(data[:,1], dtype=np.float64)
+        if len(x) == 0:
+            x = y = np.zeros(1)[:0]
+            self.origin = np.zeros(2)
+        else:
+            self.origin = np.array((np.min(x), np.min(y)))
+        
+        binX = ((x - self.origin[0]) / self.binSize).astype(np.int64)
+        binY = ((y - self.origin[1]) / self.binSize).astype(np.int64)
+        
+        # Number of level 0 tiles along each axis and number of levels
+        self.nrTiles = np.array(( binX.max() // self.tileSize + 1 if len(binX) else 1, \
+                                  binY.max() // self.tileSize + 1 if len(binY) else 1 ))
+        self.levels  = int(np.ceil(np.log2(np.max(self.nrTiles)))) + 1
+        
+        # Sort the localisations along the Z-order curve of the level 0 tiles
+        codes = mortonCode(binX // self.tileSize, binY // self.tileSize)
+        order = np.argsort(codes, kind='mergesort')
+        self.codes = codes[order]
+        self.binX  = binX[order]
+        self.binY  = binY[order]
+        
+        # The data boundaries
+        self.mins = self.origin
+        self.maxs = np.array(( np.max(x) if len(x) else 0.0, np.max(y) if len(y) else 0.0 ))
+    
+    def tileLength(self, level):
+        """ Edge length of a tile at the given level in data units """
+        return self.tileSize * self.binSize * 2**level
+    
+    def tilesPerAxis(self, level):
+        return ( (self.nrTiles - 1) >> level ) + 1
+    
+    def tile(self, level, tx, ty):
+        """
+        Histogram of the tile (tx, ty) at the given level, rows along y. The
+        counts are divided by the number of level 0 bins per bin, i.e. the
+        values are comparable between the levels.
+        """
+        key = (level, tx, ty)
+        H = self.tiles.pop(key, None)
+        if H is None:
+            H = self._computeTile(level, tx, ty)
+            while len(self.tiles) >= self.maxTiles:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = H # most recently used
+        return H
+    
+    def _computeTile(self, level, tx, ty):
+        T     = self.tileSize
+        first = int(mortonCode(tx, ty)) << (2*level)
+        start = np.searchsorted(self.codes, first,                 side='left')
+        stop  = np.searchsorted(self.codes, first + (1 << 2*level), side='left')
+        if start == stop: # empty tile
+            return np.zeros((T,T), dtype=np.float32)
+        
+        localX = (self.binX[start:stop] >> level) - tx * T
+        localY = (self.binY[start:stop] >> level) - ty * T
+        H = np.bincount(localY * T + localX, minlength=T*T).reshape(T,T)
+        return H.astype(np.float32) / 4**level
+    
+    def level(self, xlim, ylim, pixels):
+        """ The coarsest level at which a bin is still not larger than a screen pixel """
+        binsX = abs(xlim[1] - xlim[0]) / self.binSize / max(pixels[0], 1)
+        binsY = abs(ylim[1] - ylim[0]) / self.binSize / max(pixels[1], 1)
+        binsPerPixel = max(binsX, binsY)
+        if binsPerPixel <= 1:
+            return 0
+        return int(min(np.floor(np.log2(binsPerPixel)), self.levels - 1))
+    
+    def render(self, xlim, ylim, pixels):
+        """
+        Assemble the visible tiles for the view limits xlim and ylim (in data
+        units) displayed on pixels = (width, height) screen pixels. Returns
+        the image (rows along y) and its extent in the imshow convention
+        [xmin, xmax, ymax, ymin].
+        """
+        level  = self.level(xlim, ylim, pixels)
+        length = self.tileLength(level)
+        nrX, nrY = self.tilesPerAxis(level)
+        
+        # The range of visible tiles
+        xmin, xmax = sorted(xlim)
+        ymin, ymax = sorted(ylim)
+        tx0 = int(np.clip(np.floor((xmin - self.origin[0]) / length), 0, nrX-1))
+        tx1 = int(np.clip(np.floor((xmax - self.origin[0]) / length), 0, nrX-1))
+        ty0 = int(np.clip(np.floor((ymin - self.origin[1]) / length), 0, nrY-1))
+        ty1 = int(np.clip(np.floor((ymax - self.origin[1]) / length), 0, nrY-1))
+        
+        T = self.tileSize
+        H = np.empty(((ty1-ty0+1) * T, (tx1-tx0+1) * T), dtype=np.float32)
+        for ty in range(ty0, ty1+1):
+            for tx in range(tx0, tx1+1):
+                H[(ty-ty0)*T:(ty-ty0+1)*T, (tx-tx0)*T:(tx-tx0+1)*T] = self.tile(level, tx, ty)
+        
+        extent = [ self.origin[0] + tx0 * length, self.origin[0] + (tx1+1) * length, \
+                   self.origin[1] + (ty1+1) * length, self.origin[1] + ty0 * length ]
+        return H, extent
+
+
 class ImageHistogram(object):
     """ Simple class to plot super-resolution localisation data in a 2D histogram. """
-    def __init__(self, gaussianFilter=False, sigma=1):
+    def __init__(self, gaussianFilter=False, sigma=1, blurBackend='auto'):
         
         self.color          = None
         self.gaussianFilter = gaussianFilter
         self.sigma          = sigma
+        self.blurBackend    = blurBackend
+        self.blurInfo       = None # (backend, seconds) of the last blur
     
-    def __call__(self, data, scaleMin=None, scaleMax=None, binSize=1):
-        
+    def _bins(self, data, binSize):
+        """ Number of bins needed to reach binSize for each bin """
         # From the docs we read "Values in x are histogrammed along the first dimension"
         # so we flip around to make it comparable to the image.
         X = data[:,1]
         Y = data[:,0]
         
-        # Calculate how many bins are needed to reach binSize for each bin
-        binsX = np.ceil(((np.max(X)) - np.min(X)) / float(binSize))
-        binsY = np.ceil(((np.max(Y)) - np.min(Y)) / float(binSize))
+        binsX = max(int(np.ceil(((np.max(X)) - np.min(X)) / float(binSize))), 1)
+        binsY = max(int(np.ceil(((np.max(Y)) - np.min(Y)) / float(binSize))), 1)
+        return X, Y, (binsX, binsY)
+    
+    def histogram(self, data, binSize=1):
+        """ The raw (not blurred) 2D histogram and its extent """
+        X, Y, bins = self._bins(data, binSize)
         
         # Compute the 2D histogram
-        H, xedges, yedges = np.histogram2d(X, Y, bins=(binsX,binsY))
+        H, xedges, yedges = histogramUniform(X, Y, bins=bins)
         extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]] # the boundaries of the histogram
+        return H, extent
+    
+    def gaussianRendering(self, data, precision, binSize=1, sigmaStep=0.2, minSigma=0.25, truncate=3.0, chunkSize=2**24):
+        """
+        Render each localisation as a gaussian with its own localisation
+        precision. The histogram bins and the extent are the same as for
+        histogram(), each localisation adds a total intensity of one.
+        
+        precision: the sigma in x and y of each localisation (in units of
+                   the positions, i.e. pixels)
+        sigmaStep: relative quantisation step of sigma. The localisations
+                   are grouped by the quantised sigma, such that the image
+                   is blurred once per group instead of once per point.
+        minSigma:  sigmas below this value (in bins) are not blurred
+        """
+        X, Y, bins = self._bins(data, binSize)
+        xedges, yedges = uniformEdges(X, Y, bins)
+        rows = _binIndex(np.asarray(X, dtype=np.float64), xedges)
+        cols = _binIndex(np.asarray(Y, dtype=np.float64), yedges)
+        
+        # The sigma along the rows of H is the precision in y and vice versa
+        levelRows = _sigmaLevel(np.asarray(precision[:,1], dtype=np.float64) / binSize, sigmaStep, minSigma)
+        levelCols = _sigmaLevel(np.asarray(precision[:,0], dtype=np.float64) / binSize, sigmaStep, minSigma)
+        
+        # The gaussian is separable, i.e. for each sigma along the columns
+        # the kernels along the rows are splatted (one 1D kernel per point,
+        # summed with np.bincount) and the sum is blurred once along the
+        # columns.
+        levels, group = np.unique(levelCols, return_inverse=True)
+        order   = np.argsort(group, kind='mergesort')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=len(levels)))))
+        
+        H = np.zeros(bins, dtype=np.float32)
+        for index in xrange(len(levels)):
+            members      = order[offsets[index]:offsets[index+1]]
+            r, c         = rows[members], cols[members]
+            memberLevels = levelRows[members]
+            sigmaCols    = _levelSigma(levels[index], sigmaStep)
+            
+            # Only the part of the image that is covered by this group
+            padRows = int(np.ceil(truncate * _levelSigma(memberLevels.max(), sigmaStep)))
+            padCols = int(np.ceil(truncate * sigmaCols))
+            r0, r1  = max(r.min() - padRows, 0), min(r.max() + padRows + 1, bins[0])
+            c0, c1  = max(c.min() - padCols, 0), min(c.max() + padCols + 1, bins[1])
+            shape   = (r1 - r0, c1 - c0)
+            
+            # The row kernels of all points, summed in chunks of about
+            # chunkSize values. The points of one level are split as well.
+            block   = np.zeros(shape[0] * shape[1], dtype=np.float64)
+            indices = list()
+            weights = list()
+            def addChunk():
+                block[:] += np.bincount(np.concatenate(indices), weights=np.concatenate(weights), minlength=len(block))
+                del indices[:], weights[:]
+            
+            pending = 0
+            for level in np.unique(memberLevels):
+                points = np.flatnonzero(memberLevels == level)
+                kernel = _gaussianKernel1d(_levelSigma(level, sigmaStep), truncate)
+                offset = np.arange(len(kernel)) - len(kernel) // 2
+                step   = max(chunkSize // len(kernel), 1)
+                for start in xrange(0, len(points), step):
+                    selected = points[start:start+step]
+                    # Reflect at the image border, same as the gaussian blur
+                    kernelRows = _reflectIndex(r[selected][:,None] + offset, bins[0]) - r0
+                    indices.append( (kernelRows * shape[1] + (c[selected][:,None] - c0)).ravel() )
+                    weights.append( np.broadcast_to(kernel, kernelRows.shape).ravel() )
+                    pending += kernelRows.size
+                    if pending >= chunkSize:
+                        addChunk()
+                        pending = 0
+            if pending > 0:
+                addChunk()
+            
+            H[r0:r1,c0:c1] += gaussianBlur(block.reshape(shape), (0, sigmaCols), truncate=truncate)[0]
+        
+        extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
+        return H, extent
+    
+    def blur(self, H, sigma=None):
+        """ Apply the gaussian filter to the histogram H (sigma in bins) """
+        if sigma is None:
+            sigma = self.sigma
+        start = time.time()
+        H, backend = gaussianBlur(H, sigma, self.blurBackend)
+        self.blurInfo = (backend, time.time() - start)
+        return H
+    
+    def __call__(self, data, scaleMin=None, scaleMax=None, binSize=1):
+        
+        H, extent = self.histogram(data, binSize)
         
         # Get the color class used to add the colorbar to the histogram
         if scaleMin == None and scaleMax == None:
@@ -274,7 +822,7 @@ class ImageHistogram(object):
         
         # Apply the gaussian filter if desired
         if self.gaussianFilter:
-            H = gaussian_filter(H, self.sigma)
+            H = self.blur(H)
             
         return H, extent, sm, scaleMin, scaleMax
         
@@ -301,9 +849,12 @@ class ImageHistogram(object):
         color = Color(scaleMin, scaleMax)
         return color, scaleMin, scaleMax
 
-    def setGaussianBlur(self, blur, sigma):
+    def setGaussianBlur(self, blur, sigma, backend=None):
         self.gaussianFilter = blur
         self.sigma          = sigma
+        if backend is not None:
+            assert( backend in ('auto', ) + tuple(blurBackends) )
+            self.blurBackend = backend
 
 
 